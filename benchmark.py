@@ -0,0 +1,370 @@
+"""
+Benchmarks the conversion pipeline of epub2cbz.py on generated epubs.
+
+Synthetic fixed-layout epubs are written to a temporary folder, then every
+stage of process_epub is timed per book and the whole main() batch is timed
+on the same files. Run "python benchmark.py --help" for the options.
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from PIL import Image
+from rich import print as rprint
+
+import epub2cbz
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore[assignment]
+
+
+stages = [
+    "map_fixed_layout_pages",
+    "parse_epub_toc",
+    "parse_epub_opf",
+    "parse_metadata",
+    "parse_alternative_cover",
+    "parse_alternative_toc",
+    "extract_images",
+    "write_chapters_to_txt",
+]
+
+
+def create_image(width, height, extension, seed):
+    """a noisy image, so it compresses like a scanned page"""
+    image = Image.effect_noise((width, height), 40 + seed % 40).convert("RGB")
+    image_file = io.BytesIO()
+    image.save(image_file, format=Image.registered_extensions()["." + extension])
+    return image_file.getvalue()
+
+
+def create_epub(
+    path,
+    pages=200,
+    width=1200,
+    height=1800,
+    extension="jpg",
+    toc="ncx",
+    css_cover=False,
+    guide_toc=False,
+    variants=8,
+):
+    """
+    Writes a synthetic fixed-layout epub with one xhtml page per image.
+
+    Args:
+        path: Path of the epub to write.
+        pages: Number of image pages.
+        width: Width of the images.
+        height: Height of the images.
+        extension: Image format, "jpg" or "png".
+        toc: "ncx" for a toc.ncx table of contents, "nav" for a nav.xhtml.
+        css_cover: Show the cover as a css background instead of an <img>.
+        guide_toc: Add a table of contents page referenced from the <guide>.
+        variants: Number of distinct images cycled through the pages.
+    """
+    media_type = "image/png" if extension == "png" else "image/jpeg"
+    images = [create_image(width, height, extension, seed) for seed in range(variants)]
+    manifest = ['<item id="css" href="style.css" media-type="text/css"/>']
+    spine = []
+    chapters = []
+
+    with ZipFile(path, "w", ZIP_DEFLATED) as epub:
+        epub.writestr("mimetype", "application/epub+zip", compress_type=ZIP_STORED)
+        epub.writestr(
+            "META-INF/container.xml",
+            '<?xml version="1.0"?>\n<container version="1.0" '
+            'xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" '
+            'media-type="application/oebps-package+xml"/></rootfiles>\n'
+            "</container>",
+        )
+        epub.writestr(f"OEBPS/images/cover.{extension}", images[0])
+        manifest.append(
+            f'<item id="cover-image" href="images/cover.{extension}" '
+            f'media-type="{media_type}"/>'
+        )
+        if css_cover:
+            epub.writestr(
+                "OEBPS/style.css",
+                "body { margin: 0; }\n#cover { background-image: "
+                f'url("images/cover.{extension}"); }}\n',
+            )
+            cover_body = '<div id="cover"></div>'
+        else:
+            epub.writestr("OEBPS/style.css", "body { margin: 0; }\n")
+            cover_body = f'<img src="../images/cover.{extension}" alt=""/>'
+        epub.writestr("OEBPS/xhtml/cover.xhtml", page_xhtml(cover_body))
+        manifest.append(
+            '<item id="cover" href="xhtml/cover.xhtml" '
+            'media-type="application/xhtml+xml"/>'
+        )
+        spine.append('<itemref idref="cover"/>')
+        chapters.append(("Cover", "xhtml/cover.xhtml"))
+
+        if guide_toc:
+            links = "\n".join(
+                f'<p><a href="p{page:04}.xhtml">Chapter {page // 20 + 1}</a></p>'
+                for page in range(1, pages + 1, 20)
+            )
+            epub.writestr("OEBPS/xhtml/toc.xhtml", page_xhtml(links))
+            manifest.append(
+                '<item id="toc-page" href="xhtml/toc.xhtml" '
+                'media-type="application/xhtml+xml"/>'
+            )
+            spine.append('<itemref idref="toc-page"/>')
+
+        for page in range(1, pages + 1):
+            image_href = f"images/i{page:04}.{extension}"
+            epub.writestr(f"OEBPS/{image_href}", images[page % variants])
+            epub.writestr(
+                f"OEBPS/xhtml/p{page:04}.xhtml",
+                page_xhtml(
+                    f'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+                    f'viewBox="0 0 {width} {height}"><image width="{width}" '
+                    f'height="{height}" xlink:href="../{image_href}"/></svg>'
+                ),
+            )
+            manifest.append(
+                f'<item id="i{page:04}" href="{image_href}" media-type="{media_type}"/>'
+            )
+            manifest.append(
+                f'<item id="p{page:04}" href="xhtml/p{page:04}.xhtml" '
+                'media-type="application/xhtml+xml" properties="svg"/>'
+            )
+            spine.append(f'<itemref idref="p{page:04}"/>')
+            if page % 20 == 1:
+                chapters.append(
+                    (f"Chapter {page // 20 + 1}", f"xhtml/p{page:04}.xhtml")
+                )
+
+        if toc == "nav":
+            links = "\n".join(
+                f'<li><a href="{href}">{title}</a></li>' for title, href in chapters
+            )
+            epub.writestr(
+                "OEBPS/nav.xhtml",
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml" '
+                'xmlns:epub="http://www.idpf.org/2007/ops">\n<body>\n'
+                f'<nav epub:type="toc">\n<ol>\n{links}\n</ol>\n</nav>\n'
+                "</body>\n</html>",
+            )
+            manifest.append(
+                '<item id="nav" href="nav.xhtml" properties="nav" '
+                'media-type="application/xhtml+xml"/>'
+            )
+        else:
+            nav_points = "\n".join(
+                f'<navPoint id="n{i}" playOrder="{i + 1}"><navLabel><text>{title}'
+                f'</text></navLabel><content src="{href}"/></navPoint>'
+                for i, (title, href) in enumerate(chapters)
+            )
+            epub.writestr(
+                "OEBPS/toc.ncx",
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+                f"<navMap>\n{nav_points}\n</navMap>\n</ncx>",
+            )
+            manifest.append(
+                '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+            )
+
+        guide = (
+            '<guide>\n<reference type="toc" title="Contents" href="xhtml/toc.xhtml"/>\n'
+            "</guide>\n"
+            if guide_toc
+            else ""
+        )
+        newline = "\n"
+        epub.writestr(
+            "OEBPS/content.opf",
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" '
+            'unique-identifier="uid" prefix="rendition: '
+            'http://www.idpf.org/vocab/rendition/#">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            '<dc:identifier id="uid">urn:uuid:benchmark</dc:identifier>\n'
+            "<dc:title>Benchmark Book</dc:title>\n"
+            "<dc:creator>Benchmark Author</dc:creator>\n"
+            "<dc:language>en</dc:language>\n"
+            "<dc:publisher>Benchmark Publisher</dc:publisher>\n"
+            "<dc:date>2024-01-31</dc:date>\n"
+            "<dc:description>A synthetic book.</dc:description>\n"
+            '<meta name="cover" content="cover-image"/>\n'
+            '<meta property="rendition:layout">pre-paginated</meta>\n'
+            "</metadata>\n"
+            f"<manifest>\n{newline.join(manifest)}\n</manifest>\n"
+            f'<spine toc="ncx" page-progression-direction="rtl">\n'
+            f"{newline.join(spine)}\n</spine>\n"
+            f"{guide}</package>",
+        )
+
+
+def page_xhtml(body):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" '
+        'xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+        '<head><link href="../style.css" rel="stylesheet" type="text/css"/></head>\n'
+        f"<body>\n{body}\n</body>\n</html>"
+    )
+
+
+def get_peak_rss():
+    """peak resident set size of this process and its children in MB"""
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def benchmark_stages(epub_path, output_dir):
+    """times each stage of process_epub for one book, returns the timings"""
+    timings = dict.fromkeys(stages, 0.0)
+    epub_filename = epub2cbz.get_epub_filename(epub_path)
+
+    def timed(stage, *args):
+        start = time.perf_counter()
+        result = getattr(epub2cbz, stage)(*args)
+        timings[stage] += time.perf_counter() - start
+        return result
+
+    with epub2cbz.EpubContext(epub_path) as ctx:
+        timed("map_fixed_layout_pages", ctx)
+        chapters = timed("parse_epub_toc", ctx)
+        book_full = timed("parse_epub_opf", ctx)
+        metadata = [timed("parse_metadata", ctx)]
+        book_full = timed("parse_alternative_cover", ctx, book_full)
+        chapters = timed("parse_alternative_toc", ctx, chapters, book_full)
+        output = epub2cbz.FolderOutput(os.path.join(output_dir, epub_filename))
+        timed("extract_images", ctx, epub_filename, book_full, output)
+        reading_direction = epub2cbz.parse_reading_direction(ctx)
+        timed(
+            "write_chapters_to_txt",
+            chapters,
+            epub_filename,
+            output_dir,
+            reading_direction,
+            book_full,
+            metadata,
+            output,
+        )
+        output.close()
+    return timings, len(book_full)
+
+
+def benchmark_main(work_dir, jobs, cbz):
+    """times a whole main() batch run over the generated books"""
+    cwd = os.getcwd()
+    argv = sys.argv
+    sys.argv = ["epub2cbz.py", "--no-cache", "--jobs", str(jobs)]
+    if cbz:
+        sys.argv.append("--cbz")
+    os.chdir(work_dir)
+    try:
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            epub2cbz.main()
+        return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        sys.argv = argv
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--books", type=int, default=4, help="number of epubs")
+    parser.add_argument("--pages", type=int, default=200, help="pages per epub")
+    parser.add_argument("--width", type=int, default=1200, help="image width")
+    parser.add_argument("--height", type=int, default=1800, help="image height")
+    parser.add_argument("--format", choices=["jpg", "png"], default="jpg")
+    parser.add_argument("--toc", choices=["ncx", "nav"], default="ncx")
+    parser.add_argument(
+        "--css-cover", action="store_true", help="cover as a css background"
+    )
+    parser.add_argument(
+        "--guide-toc", action="store_true", help="add a <guide> toc page"
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="jobs for the main() batch run"
+    )
+    parser.add_argument("--cbz", action="store_true", help="batch run with --cbz")
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="epub2cbz-benchmark-") as tmp_dir:
+        epub_dir = os.path.join(tmp_dir, "epubs")
+        output_dir = os.path.join(tmp_dir, "stages")
+        os.makedirs(epub_dir)
+        os.makedirs(output_dir)
+
+        start = time.perf_counter()
+        epub_paths = []
+        for number in range(1, args.books + 1):
+            epub_path = os.path.join(epub_dir, f"Benchmark v{number}.epub")
+            create_epub(
+                epub_path,
+                pages=args.pages,
+                width=args.width,
+                height=args.height,
+                extension=args.format,
+                toc=args.toc,
+                css_cover=args.css_cover,
+                guide_toc=args.guide_toc,
+            )
+            epub_paths.append(epub_path)
+        epub_bytes = sum(os.path.getsize(epub_path) for epub_path in epub_paths)
+        epub_mb = epub_bytes / (1024 * 1024)
+        rprint(
+            f"Generated {args.books} epubs, {epub_mb:.1f} MB, "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+        totals = dict.fromkeys(stages, 0.0)
+        pages = 0
+        for epub_path in epub_paths:
+            with redirect_stdout(io.StringIO()):
+                timings, book_pages = benchmark_stages(epub_path, output_dir)
+            pages += book_pages
+            for stage, seconds in timings.items():
+                totals[stage] += seconds
+        total = sum(totals.values())
+
+        rprint(f"[bold]{'stage':<24}{'seconds':>10}{'share':>8}[/]")
+        for stage, seconds in totals.items():
+            share = seconds / total * 100 if total else 0
+            rprint(f"{stage:<24}{seconds:>10.3f}{share:>7.1f}%")
+        rprint(
+            f"[bold]{'all stages':<24}{total:>10.3f}[/]  "
+            f"{pages / total:.0f} pages/s, {epub_mb / total:.1f} MB/s"
+        )
+
+        batch = benchmark_main(epub_dir, args.jobs, args.cbz)
+        rprint(
+            f"[bold]main() batch, {args.jobs} job(s):[/] {batch:.3f}s, "
+            f"{pages / batch:.0f} pages/s, {epub_mb / batch:.1f} MB/s"
+        )
+
+    peak_rss = get_peak_rss()
+    if peak_rss is not None:
+        rprint(f"Peak RSS: {peak_rss:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
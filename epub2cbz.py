@@ -1,73 +1,505 @@
+import argparse
+import codecs
+import hashlib
+import io
+import json
 import os
+import posixpath
+import queue
 import re
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
 from bs4 import BeautifulSoup
-from zipfile import ZipFile
-from rich import print as rprint
+from zipfile import (
+    ZIP64_LIMIT,
+    ZIP_BZIP2,
+    ZIP_DEFLATED,
+    ZIP_LZMA,
+    ZIP_STORED,
+    BadZipFile,
+    ZipFile,
+    ZipInfo,
+)
+from rich import print as rprint, reconfigure
 from PIL import Image
-from shutil import rmtree
+from shutil import copyfile, rmtree
 from datetime import datetime
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+from urllib.parse import unquote, urlsplit
+from multiprocessing import Event, Pool
+from fnmatch import fnmatch
+from functools import lru_cache, partial
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from dataclasses import dataclass, field, fields, replace
+from typing import Optional
+
+
+__version__ = "1.1.0"
+
+"""file in the converted folder remembering the books already converted"""
+cache_filename = ".epub2cbz-cache.json"
+"""file in the watched folder queuing the books found by --watch"""
+jobs_filename = ".epub2cbz-jobs.sqlite"
+
+"""bytes of an archive member read or written at a time, bounds the memory a
+conversion needs for image data no matter how large the epub is"""
+chunk_size = 1024 * 1024
+"""items handed between the read, process and write stages of a conversion,
+reading runs ahead of writing by at most this many chunks or pages"""
+queue_depth = 8
+
+
+@dataclass(frozen=True)
+class Transcode:
+    """how the pages are re-encoded, see transcode_image"""
+
+    """(width, height) the pages are scaled down to fit in, None to keep it"""
+    size: Optional[tuple] = None
+    """"jpg", "png" or "webp", None to keep the format of each page"""
+    format: Optional[str] = None
+    """jpg and webp quality"""
+    quality: int = 85
+    """convert the pages to grayscale"""
+    grayscale: bool = False
+    """threads re-encoding the pages of a book, 0 for one per core"""
+    threads: int = 0
+
+    def __post_init__(self):
+        if self.size is not None:
+            object.__setattr__(self, "size", tuple(self.size))
+
+
+@dataclass(frozen=True)
+class Options:
+    """
+    Everything a conversion can be configured with.
+
+    Options, their Transcode and fingerprints included, are immutable and
+    handed down to every function that needs them, so books with different
+    options can be converted at the same time, on threads of one process or on
+    the workers of a pool. Derive the options of one job from another with
+    dataclasses.replace; load_options reads them from a config file and the
+    command line.
+    """
+
+    """extract and rename images in spine order"""
+    extract_images: bool = True
+    """delete temp folders"""
+    delete_temp: bool = True
+    """write .cbz archives directly instead of folders"""
+    cbz: bool = False
+
+    """create comicinfo.xml file"""
+    comicinfo: bool = True
+    """add title to comicinfo"""
+    title: bool = True
+    """add volume number to comicinfo"""
+    volume_no: bool = True
+    """add series to comicinfo"""
+    series: bool = True
+    """add author to comicinfo"""
+    author: bool = True
+    """add publisher to comicinfo"""
+    publisher: bool = True
+    """add language info to comicinfo"""
+    language: bool = True
+    """add release date to comicinfo"""
+    date: bool = True
+    """add reading direction to comicinfo"""
+    reading_dir: bool = True
+    """add description to comicinfo"""
+    description: bool = True
+    """add chapter info to comicinfo"""
+    chapters: bool = True
+
+    """books converted in parallel"""
+    jobs: int = 1
+    """bytes of an archive member read or written at a time"""
+    chunk_size: int = chunk_size
+    """deflate level of compressed .cbz entries from 0 to 9, None for zlib's
+    default"""
+    compression_level: Optional[int] = None
+    """bytes of encoded image data a conversion holds between its stages, 0 for
+    no limit beyond queue_depth"""
+    memory_limit: int = 0
+    """how the pages are re-encoded, also given as a dict of the Transcode
+    fields, None to copy them"""
+    transcode: Optional[Transcode] = None
+    """images of pages left out of the books, as returned by load_fingerprints"""
+    fingerprints: Optional[frozenset] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if isinstance(self.transcode, dict):
+            object.__setattr__(self, "transcode", Transcode(**self.transcode))
+        if self.fingerprints is not None:
+            object.__setattr__(self, "fingerprints", frozenset(self.fingerprints))
+        if self.chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, not {self.chunk_size}")
+        if self.compression_level is not None and not 0 <= self.compression_level <= 9:
+            raise ValueError(
+                f"compression_level must be 0 to 9, not {self.compression_level}"
+            )
+
+    def get_queue_depth(self, item_size=None, buffers=2):
+        """
+        The chunks or pages a queue between two stages holds.
+
+        Args:
+            item_size: Bytes of one item in the queue, chunk_size if None.
+            buffers: How many such queues share the memory limit.
+        """
+        if not self.memory_limit:
+            return queue_depth
+        item_size = item_size or self.chunk_size
+        return max(1, min(queue_depth, self.memory_limit // (buffers * item_size)))
+
+
+default_options = Options()
+
+
+def build_path_index(names):
+    """
+    Indexes the entries of an archive by normalized path and by basename.
+
+    Basenames shared by several entries are left out, so a lookup never picks
+    an arbitrary one of them.
+    """
+    paths = {}
+    basenames = {}
+    duplicates = set()
+    for name in names:
+        if name.endswith("/"):
+            continue
+        paths[posixpath.normpath(name)] = name
+        basename = posixpath.basename(name)
+        if basename in basenames:
+            duplicates.add(basename)
+        basenames[basename] = name
+    for basename in duplicates:
+        del basenames[basename]
+    return paths, basenames
+
+
+class Profile:
+    """
+    Wall time and i/o of the stages of one book conversion.
+
+    The counters are updated by the EpubContext and the output of the book,
+    stage() attributes what changed while it was active to a named stage.
+    """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(
+            ["zip_opens", "member_reads", "bytes_read", "bytes_written"], 0
+        )
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        before = dict(self.counters)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(
+                name, dict.fromkeys(["seconds", *self.counters], 0)
+            )
+            stage["seconds"] += time.perf_counter() - start
+            for key, value in self.counters.items():
+                stage[key] += value - before[key]
+
+    def report(self):
+        return {
+            "seconds": sum(stage["seconds"] for stage in self.stages.values()),
+            **self.counters,
+            "stages": self.stages,
+        }
+
+
+class CountingFile:
+    """wraps a binary file and counts the bytes read from it"""
+
+    def __init__(self, file, counters):
+        self.file = file
+        self.counters = counters
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.counters["bytes_read"] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
 
+class CountingZipFile(ZipFile):
+    """ZipFile counting the members opened or copied raw for reading"""
 
-"""extract and rename images in spine order"""
-btn_extract_images = 1
-"""delete temp folders"""
-btn_delete_temp = 1
-
-"""create comicinfo.xml file"""
-btn_comicinfo = 1
-"""add title to comicinfo"""
-btn_title = 1
-"""add volume number to comicinfo"""
-btn_volume_no = 1
-"""add series to comicinfo"""
-btn_series = 1
-"""add author to comicinfo"""
-btn_author = 1
-"""add publisher to comicinfo"""
-btn_publisher = 1
-"""add language info to comicinfo"""
-btn_language = 1
-"""add release date to comicinfo"""
-btn_date = 1
-"""add reading direction to comicinfo"""
-btn_reading_dir = 1
-"""add description to comicinfo"""
-btn_description = 1
-"""add chapter info to comicinfo"""
-btn_chapters = 1
-
-
-def get_toc_file(epub, new_chapters, book_full, number):
+    def __init__(self, file, counters):
+        self.counters = counters
+        super().__init__(file, "r")
+
+    def open(self, name, mode="r", pwd=None, *, force_zip64=False):
+        if mode == "r":
+            self.counters["member_reads"] += 1
+        return super().open(name, mode, pwd, force_zip64=force_zip64)
+
+    def read_raw(self, member_info, chunk_size=chunk_size):
+        """the compressed data of a member in chunks, see read_raw_member"""
+        self.counters["member_reads"] += 1
+        return read_raw_member(self, member_info, chunk_size)
+
+
+def local_name(tag):
+    """tag or attribute name without its {namespace}"""
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_xml(data):
+    """
+    Parses an xml document, recovering from malformed markup.
+
+    Well-formed documents are parsed once with ElementTree. Documents it
+    rejects are cleaned up by BeautifulSoup's lenient xml parser first.
+    """
+    try:
+        return ElementTree.fromstring(data)
+    except ElementTree.ParseError:
+        soup = BeautifulSoup(data, features="xml")
+        return ElementTree.fromstring(str(soup).encode("utf-8"))
+
+
+class OpfModel:
+    """
+    Everything the converter uses from a .opf, collected in one pass.
+
+    Attributes:
+        manifest: The manifest <item>s as dicts of their attributes, in order.
+        items: The same dicts keyed by id.
+        spine: The idrefs of the spine <itemref>s, in order.
+        metadata: The text of the first dc:title, dc:creator, dc:language,
+            dc:publisher, dc:date and dc:description, keyed by their name.
+        cover: The content of <meta name="cover">.
+        properties: The text of the <meta property="..."> elements, like
+            rendition:layout, keyed by their property.
+        guide: The hrefs of the guide <reference>s, keyed by their type.
+        page_progression_direction: The page-progression-direction of the
+            spine.
+    """
+
+    def __init__(self, data):
+        self.manifest = []
+        self.items = {}
+        self.spine = []
+        self.metadata = {}
+        self.cover = ""
+        self.properties = {}
+        self.guide = {}
+        self.page_progression_direction = ""
+
+        for element in parse_xml(data).iter():
+            if not isinstance(element.tag, str):
+                continue
+            tag = local_name(element.tag)
+            attrs = {local_name(key): value for key, value in element.attrib.items()}
+            if tag == "item":
+                self.manifest.append(attrs)
+                if attrs.get("id"):
+                    self.items.setdefault(attrs["id"], attrs)
+            elif tag == "itemref":
+                if attrs.get("idref"):
+                    self.spine.append(attrs["idref"])
+            elif tag == "spine":
+                self.page_progression_direction = attrs.get(
+                    "page-progression-direction", ""
+                )
+            elif tag == "reference":
+                if attrs.get("type") and attrs.get("href"):
+                    self.guide.setdefault(attrs["type"], attrs["href"])
+            elif tag == "meta":
+                if attrs.get("name") == "cover" and not self.cover:
+                    self.cover = attrs.get("content", "")
+                elif attrs.get("property"):
+                    self.properties.setdefault(
+                        attrs["property"], "".join(element.itertext()).strip()
+                    )
+            elif element.tag.startswith("{http://purl.org/dc/elements/1.1/}"):
+                text = "".join(element.itertext()).strip()
+                if text and tag not in self.metadata:
+                    self.metadata[tag] = text
+
+    def items_by_media_type(self, media_type):
+        return [item for item in self.manifest if item.get("media-type") == media_type]
+
+    def items_by_media_type_prefix(self, prefix):
+        return [
+            item
+            for item in self.manifest
+            if item.get("media-type", "").startswith(prefix)
+        ]
+
+    def items_by_property(self, name):
+        return [
+            item for item in self.manifest if name in item.get("properties", "").split()
+        ]
+
+
+class ValidationError(Exception):
+    """
+    A book that can't be converted, found before anything is written.
+
+    reason is a short code to triage books by, see validate_epub.
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(f"{reason}: {message}")
+        self.reason = reason
+
+
+class EpubContext:
+    """
+    One open epub archive, shared by all parsers of a single book.
+
+    The zip file is opened once, its central directory is listed and indexed
+    once and the .opf is read, decoded and parsed once. The image found on each
+    page is remembered, so pages shared by the spine and the table of contents
+    are only searched once, and the stylesheets are indexed on first use.
+    Reads from the archive are counted in the profile of the book. Use as a
+    context manager to close the archive when the book is done.
+
+    The epub is a path, its content as bytes or a seekable binary file object
+    opened for reading. A file object passed in is left open. Image data is read
+    in chunks and queued between stages as the options allow.
+    """
+
+    def __init__(self, epub_file, opf_path=None, profile=None, options=default_options):
+        self.epub_file = epub_file
+        self.chunk_size = options.chunk_size
+        self.options = options
+        self.queue_depth = options.get_queue_depth()
+        self.profile = profile or Profile()
+        self.profile.counters["zip_opens"] += 1
+        self.owns_file = not hasattr(epub_file, "read")
+        if isinstance(epub_file, (bytes, bytearray, memoryview)):
+            self.file = io.BytesIO(epub_file)
+        elif self.owns_file:
+            self.file = open(epub_file, "rb")
+        else:
+            self.file = epub_file
+        try:
+            try:
+                self.epub = CountingZipFile(
+                    CountingFile(self.file, self.profile.counters),
+                    self.profile.counters,
+                )
+            except BadZipFile as e:
+                raise ValidationError("not_a_zip", str(e)) from e
+            self.names = self.epub.namelist()
+            self.paths, self.basenames = build_path_index(self.names)
+            self.opf_path = opf_path or get_opf_file(self.epub)
+            if "/" in self.opf_path:
+                self.opf_dir = self.opf_path.rsplit("/", 1)[0] + "/"
+            else:
+                self.opf_dir = ""
+            try:
+                opf_data = self.epub.read(self.opf_path)
+            except KeyError as e:
+                raise ValidationError(
+                    "missing_opf", f"'{self.opf_path}' is not in the archive"
+                ) from e
+            self.opf = OpfModel(opf_data)
+            self.page_images = {}
+            self.css_images = None
+        except Exception:
+            self.close()
+            raise
+
+    def resolve(self, href, base_dir=None):
+        """
+        Resolves an href to the name of an entry in the archive.
+
+        Args:
+            href: The href as found in the .opf, a page or a stylesheet.
+            base_dir: Directory of the file containing the href, defaults to
+                the directory of the .opf.
+
+        Returns:
+            The archive entry name or None if no entry matches.
+        """
+        if not href:
+            return None
+        href = unquote(href.split("#", 1)[0].strip())
+        if base_dir is None:
+            base_dir = self.opf_dir
+        for candidate in (posixpath.join(base_dir, href), href):
+            name = self.paths.get(posixpath.normpath(candidate))
+            if name:
+                return name
+        return self.basenames.get(posixpath.basename(href))
+
+    def close(self):
+        if hasattr(self, "epub"):
+            self.epub.close()
+        if self.owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_page_key(page):
+    """key matching a toc or chapter href to its spine page, ignoring anchors"""
+    return os.path.basename(page.rsplit("#", 1)[0])
+
+
+def get_pages_by_key(book_full):
+    """maps the key of each spine page to its first entry in book_full"""
+    pages = {}
+    for book in book_full:
+        pages.setdefault(get_page_key(book["page"]), book)
+    return pages
+
+
+def get_toc_file(ctx, new_chapters, book_full, number):
     new_toc = []
-    toc = []
     pattern_href = r'<a href="(.*?)">'
+    pages = get_pages_by_key(book_full)
 
     i = 0
     while i < 4:
+        toc = []
         try:
-            alt_toc_file = [
-                path
-                for path in epub.namelist()
-                if remove_starting_dots(book_full[int(number) + i]["page"]) in path
-            ]
-            with epub.open(alt_toc_file[0]) as toc_content:
+            alt_toc_file = ctx.resolve(book_full[int(number) + i]["page"])
+            if not alt_toc_file:
+                break
+            with ctx.epub.open(alt_toc_file) as toc_content:
                 for line in toc_content:
                     line = line.decode("utf-8").strip()
                     if '<a href="' in line:
                         toc.append(line)
             for entry in toc:
                 match = re.search(pattern_href, entry)
-                if match:
-                    for book in book_full:
-                        if os.path.basename(book["page"]) == os.path.basename(match[1]):
-                            new_chapters.append(
-                                {
-                                    "title": f"Page {book['number'] + 1}",
-                                    "page": remove_starting_dots(match[1]),
-                                    "image": "",
-                                }
-                            )
-                            break
+                book = pages.get(get_page_key(match[1])) if match else None
+                if book:
+                    new_chapters.append(
+                        {
+                            "title": f"Page {book['number'] + 1}",
+                            "page": remove_starting_dots(match[1]),
+                            "image": "",
+                        }
+                    )
         except Exception as e:
             print(e)
             break
@@ -75,116 +507,56 @@ def get_toc_file(epub, new_chapters, book_full, number):
 
     seen = set()
     for new_chapter in new_chapters:
-        if os.path.basename(new_chapter["page"].rsplit("#", 1)[0]) not in seen:
-            seen.add(os.path.basename(new_chapter["page"].rsplit("#", 1)[0]))
+        page_key = get_page_key(new_chapter["page"])
+        if page_key not in seen:
+            seen.add(page_key)
             new_toc.append(new_chapter.copy())
     return new_toc
 
 
-def parse_alternative_toc(epub_file, opf_path, chapters, book_full):
-    is_between_tags = False
-    guide = []
+def parse_alternative_toc(ctx, chapters, book_full):
     new_toc = []
-    pattern_toc = r'<reference type="toc"(.*?)href="(.*?)"/>'
-    alt_toc_file = ""
+    alt_toc_file = ctx.opf.guide.get("toc", "")
 
-    with ZipFile(epub_file, "r") as epub:
-        with epub.open(opf_path) as opf_content:
-            for line in opf_content:
-                line = line.decode("utf-8").strip()
-                if "<guide" in line:
-                    is_between_tags = True
-                elif "</guide" in line:
-                    if is_between_tags:
-                        guide.append(line)
-                        break
-                    is_between_tags = False
-                if is_between_tags:
-                    guide.append(line)
-        for line in guide:
-            matches = re.findall(pattern_toc, line)
-            if matches:
-                alt_toc_file = matches[0][1]
-                break
-        if alt_toc_file:
-            for book in book_full:
-                if os.path.basename(book["page"]) == os.path.basename(alt_toc_file):
-                    new_toc = get_toc_file(
-                        epub, chapters, book_full, int(book["number"])
-                    )
-                    break
-        else:
-            new_toc = chapters
+    if alt_toc_file:
+        book = get_pages_by_key(book_full).get(get_page_key(alt_toc_file))
+        if book:
+            new_toc = get_toc_file(ctx, chapters, book_full, int(book["number"]))
+    else:
+        new_toc = chapters
     return new_toc
 
 
-def parse_alternative_cover(epub_file, opf_path, book_full):
-    pattern_cover = r'<meta name="cover"(.+?)content="(.+?)"(.+?)?/>'
-
-    with ZipFile(epub_file, "r") as epub:
-        opf_content = epub.read(opf_path).decode("utf-8")
-        match_cover = re.findall(pattern_cover, opf_content)
-        if match_cover:
-            if (
-                match_cover[0][1].lower().endswith(".jpg")
-                or match_cover[0][1].lower().endswith(".jpeg")
-                or match_cover[0][1].lower().endswith(".png")
-            ):
-                filename = match_cover[0][1]
-                filename = remove_starting_dots(filename)
-                filename = [path for path in epub.namelist() if filename in path]
-                if filename and filename[0] in epub.namelist():
-                    if filename[0] != book_full[0]["image"]:
-                        book_full.insert(
-                            0, {"page": "Cover", "number": "0", "image": filename[0]}
-                        )
-                        for i, book in enumerate(book_full):
-                            if i > 0:
-                                book_full[i]["number"] = i + 1
+def parse_alternative_cover(ctx, book_full):
+    cover = ctx.opf.cover
+
+    if cover:
+        if (
+            cover.lower().endswith(".jpg")
+            or cover.lower().endswith(".jpeg")
+            or cover.lower().endswith(".png")
+        ):
+            filename = ctx.resolve(cover)
+            if filename:
+                if filename != book_full[0]["image"]:
+                    book_full.insert(
+                        0, {"page": "Cover", "number": "0", "image": filename}
+                    )
+                    for i, book in enumerate(book_full):
+                        if i > 0:
+                            book_full[i]["number"] = i + 1
     return book_full
 
 
-def parse_metadata(epub_file, opf_path):
-    author = ""
-    title = ""
-    language = ""
-    publisher = ""
-    date = ""
-    description = ""
-    pattern_title = r"<dc:title(.+?)?>(.+?)</dc:title>"
-    pattern_author = r"<dc:creator(.+?)?>(.+?)</dc:creator>"
-    pattern_language = r"<dc:language(.+?)?>(.+?)</dc:language>"
-    pattern_publisher = r"<dc:publisher(.+?)?>(.+?)</dc:publisher>"
-    pattern_date = r"<dc:date(.+?)?>(.+?)</dc:date>"
-    pattern_description = r"<dc:description(.+?)?>(.+?)</dc:description>"
-
-    with ZipFile(epub_file, "r") as epub:
-        opf_content = epub.read(opf_path).decode("utf-8")
-        print(opf_content)
-        match_title = re.findall(pattern_title, opf_content)
-        match_author = re.findall(pattern_author, opf_content)
-        match_language = re.findall(pattern_language, opf_content)
-        match_publisher = re.findall(pattern_publisher, opf_content)
-        match_date = re.findall(pattern_date, opf_content)
-        match_description = re.findall(
-            pattern_description, opf_content, flags=re.DOTALL
-        )
-
-        if match_title:
-            title = match_title[0][1]
-        if match_author:
-            author = match_author[0][1]
-        if match_language:
-            language = match_language[0][1]
-        if match_publisher:
-            publisher = match_publisher[0][1]
-        if match_date:
-            date = match_date[0][1]
-            if len(date) > 10:
-                date = date[:10]
-        if match_description:
-            pattern_space = r"\s+"
-            description = re.sub(pattern_space, " ", match_description[0][1])
+def parse_metadata(ctx):
+    metadata = ctx.opf.metadata
+    title = metadata.get("title", "")
+    author = metadata.get("creator", "")
+    language = metadata.get("language", "")
+    publisher = metadata.get("publisher", "")
+    date = metadata.get("date", "")[:10]
+    pattern_space = r"\s+"
+    description = re.sub(pattern_space, " ", metadata.get("description", ""))
     return author, title, language, publisher, date, description
 
 
@@ -193,195 +565,1065 @@ def create_blank_image(dimension_x, dimension_y):
     return image
 
 
-def extract_images(epub_file, epub_filename, book_full):
-    dimension_x = 0
-    dimension_y = 0
-    extension = ""
+@lru_cache(maxsize=16)
+def get_blank_image(dimension_x, dimension_y, extension):
+    """encodes a blank page once per size and format, returns the file bytes"""
+    image = create_blank_image(dimension_x, dimension_y)
+    blank_image = io.BytesIO()
+    image.save(blank_image, format=Image.registered_extensions()["." + extension])
+    return blank_image.getvalue()
 
-    with ZipFile(epub_file, "r") as epub:
-        os.makedirs(epub_filename, exist_ok=True)
-        extension = book_full[0]["image"].rsplit(".")[1]
-        for i, book in enumerate(book_full):
-            if book["image"] and i > 0:
-                with epub.open(book["image"], "r") as zipimage:
-                    image_dimension = Image.open(zipimage)
-                    dimension_x, dimension_y = image_dimension.size
-                break
+
+def get_image_size(image_file):
+    """
+    Reads the size of a jpeg or png image from its header.
+
+    Only the bytes up to the jpeg SOF segment or the png IHDR chunk are read,
+    the image itself is not decoded.
+
+    Args:
+        image_file: A binary file object positioned at the start of the image.
+
+    Returns:
+        A (width, height) tuple or None if the header isn't understood.
+    """
+    header = image_file.read(24)
+    if header[:8] == b"\x89PNG\r\n\x1a\n" and header[12:16] == b"IHDR":
+        return struct.unpack(">II", header[16:24])
+    if header[:2] != b"\xff\xd8":
+        return None
+    data = header[2:]
+    while True:
+        while len(data) < 9:
+            chunk = image_file.read(4096)
+            if not chunk:
+                return None
+            data += chunk
+        if data[0] != 0xFF:
+            return None
+        marker = data[1]
+        if marker == 0xFF:
+            data = data[1:]
+            continue
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            data = data[2:]
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[5:9])
+            return width, height
+        length = struct.unpack(">H", data[2:4])[0]
+        skip = 2 + length
+        while len(data) < skip:
+            chunk = image_file.read(max(4096, skip - len(data)))
+            if not chunk:
+                return None
+            data += chunk
+        data = data[skip:]
+
+
+"""image formats that deflate can't shrink any further"""
+compressed_extensions = {"jpg", "jpeg", "png", "gif", "webp"}
+
+
+"""local file header of a zip entry, see zipfile.structFileHeader"""
+local_file_header = struct.Struct("<4s2B4HL2L2H")
+"""private ZipFile attributes read_raw_member, write_raw_member and CbzUpdate
+rely on, without them entries are decompressed and compressed again. Checked
+on the output only, the epub is a ZipFile of the same Python"""
+zip_internals = (
+    "_lock",
+    "_writecheck",
+    "_didModify",
+    "fp",
+    "start_dir",
+    "filelist",
+    "NameToInfo",
+)
+
+
+def has_zip_internals(archive):
+    """whether a ZipFile has the private attributes of the raw copy"""
+    return all(hasattr(archive, name) for name in zip_internals)
+
+
+def read_raw_member(source, member_info, chunk_size=chunk_size):
+    """
+    Reads the compressed data of a zip entry in chunks without decompressing it.
+
+    The data starts straight after the entry's local file header. The source
+    is only locked while a chunk is read, so other threads can read from it
+    in between.
+
+    Args:
+        source: The ZipFile opened for reading.
+        member_info: The ZipInfo of the entry in the source archive.
+        chunk_size: Number of bytes read at a time.
+
+    Yields:
+        The compressed data of the entry, at most chunk_size bytes at a time.
+    """
+    with source._lock:
+        source.fp.seek(member_info.header_offset)
+        header = local_file_header.unpack(source.fp.read(local_file_header.size))
+        if header[0] != b"PK\003\004":
+            raise BadZipFile(f"Bad local file header for '{member_info.filename}'")
+        offset = source.fp.tell() + header[10] + header[11]
+    remaining = member_info.compress_size
+    while remaining > 0:
+        with source._lock:
+            source.fp.seek(offset)
+            chunk = source.fp.read(min(remaining, chunk_size))
+        if not chunk:
+            raise BadZipFile(f"Truncated entry '{member_info.filename}'")
+        offset += len(chunk)
+        remaining -= len(chunk)
+        yield chunk
+
+
+@contextmanager
+def write_raw_member(target, member_info, name):
+    """
+    Opens an entry of a zip archive for data compressed like another entry.
+
+    The entry gets a new local file header carrying the new name, CRC and sizes
+    come from the source's central directory. The compressed data written to
+    the yielded file must be exactly that of the source entry.
+
+    Args:
+        target: The ZipFile opened for writing.
+        member_info: The ZipInfo of the entry in the source archive.
+        name: The name of the entry in the target archive.
+    """
+    info = ZipInfo(name, member_info.date_time)
+    info.compress_type = member_info.compress_type
+    info.CRC = member_info.CRC
+    info.compress_size = member_info.compress_size
+    info.file_size = member_info.file_size
+    zip64 = max(info.file_size, info.compress_size) > ZIP64_LIMIT
+
+    with target._lock:
+        target.fp.seek(target.start_dir)
+        info.header_offset = target.fp.tell()
+        target._writecheck(info)
+        target._didModify = True
+        target.fp.write(info.FileHeader(zip64))
+        data_offset = target.fp.tell()
+        yield target.fp
+        if target.fp.tell() - data_offset != info.compress_size:
+            raise BadZipFile(f"Truncated entry '{member_info.filename}'")
+        target.filelist.append(info)
+        target.NameToInfo[info.filename] = info
+        target.start_dir = target.fp.tell()
+
+
+class FolderOutput:
+    """writes the pages and ComicInfo.xml of a book into a cbz-ready folder"""
+
+    def __init__(self, path, profile=None, options=default_options):
+        self.path = path
+        self.profile = profile or Profile()
+        self.delete_temp = options.delete_temp
+        self.pages = {}
+        os.makedirs(path, exist_ok=True)
+
+    def copies_raw(self, member_info):
+        return False
+
+    @contextmanager
+    def open_page(self, name, member_info=None):
+        path = os.path.join(self.path, name)
+        # never write through a hard link left by link_page in an earlier run
+        if os.path.lexists(path):
+            os.remove(path)
+        with open(path, "wb") as page:
+            yield page
+            self.profile.counters["bytes_written"] += page.tell()
+            self.pages[name] = page.tell()
+
+    def link_page(self, name, original):
+        """stores a page with the same image as an earlier page as a hard link"""
+        path = os.path.join(self.path, name)
+        if os.path.lexists(path):
+            os.remove(path)
         try:
-            for i, book in enumerate(book_full):
-                if book["image"]:
-                    epub.extract(book["image"], epub_filename)
-                    os.rename(
-                        os.path.join(epub_filename, book["image"]),
-                        os.path.join(
-                            epub_filename,
-                            str(i).zfill(len(str(len(book_full))))
-                            + "."
-                            + book["image"].rsplit(".")[1],
-                        ),
-                    )
-                else:
-                    image = create_blank_image(dimension_x, dimension_y)
-                    image.save(
-                        os.path.join(
-                            epub_filename,
-                            str(i).zfill(len(str(len(book_full)))) + "." + extension,
+            os.link(os.path.join(self.path, original), path)
+        except OSError:
+            copyfile(os.path.join(self.path, original), path)
+            self.profile.counters["bytes_written"] += os.path.getsize(path)
+        self.pages[name] = self.pages[original]
+
+    def get_pages(self):
+        """the name and size in bytes of every page in the output"""
+        if self.pages:
+            return dict(self.pages)
+        # no page was written by this run, as with metadata_only
+        with os.scandir(self.path) as entries:
+            return {
+                entry.name: entry.stat().st_size
+                for entry in entries
+                if entry.is_file() and entry.name != "ComicInfo.xml"
+            }
+
+    def write_file(self, name, data):
+        with open(os.path.join(self.path, name), "wb") as output_file:
+            output_file.write(data)
+        self.profile.counters["bytes_written"] += len(data)
+
+    def close(self):
+        if self.delete_temp:
+            for root, dirs, _ in os.walk(self.path):
+                for dir in dirs:
+                    try:
+                        rmtree(os.path.join(root, dir))
+                        print(
+                            f"Info: Cleaned up temp folder '{os.path.join(root, dir)}'"
                         )
-                    )
-        except Exception:
-            rprint(
-                f"[red]Warning: Folder for book '{epub_filename}' not empty. Delete or empty and try again.[/]"
+                    except Exception as e:
+                        rprint(f"Exception deleting: [red]{e}[/]")
+
+    def abort(self):
+        """pages written before a failure stay, the cache doesn't list the book"""
+
+
+class CbzOutput:
+    """
+    Writes the pages and ComicInfo.xml of a book straight into a .cbz archive.
+
+    Images are copied from the epub into the archive without going through
+    the filesystem. Stored and deflated entries are copied raw, compressed data
+    and all, so only their name changes, as long as the zipfile module has the
+    internals this relies on; anything else is streamed and stored if its
+    format is already compressed, deflated otherwise. The archive is
+    written under a .part name and only renamed to its final name once it is
+    complete.
+
+    Instead of a path without the .cbz extension, path can be a seekable binary
+    file object opened for writing, which the archive is written to and which
+    is left open. Entries are deflated at the compression level of the options.
+    """
+
+    def __init__(self, path, profile=None, options=default_options):
+        self.profile = profile or Profile()
+        self.compression_level = options.compression_level
+        if hasattr(path, "write"):
+            self.path = self.part_path = None
+            self.file = path
+            self.cbz = ZipFile(path, "w", ZIP_DEFLATED)
+            self.written = path.tell()
+        else:
+            self.path = path + ".cbz"
+            self.part_path = self.path + ".part"
+            self.cbz = ZipFile(self.part_path, "w", ZIP_DEFLATED)
+            self.written = 0
+        self.raw_copy = has_zip_internals(self.cbz)
+
+    def count_written(self):
+        if not self.raw_copy:
+            # counted all at once when the archive is closed
+            return
+        self.profile.counters["bytes_written"] += self.cbz.fp.tell() - self.written
+        self.written = self.cbz.fp.tell()
+
+    def zip_info(self, name, date_time=None):
+        info = ZipInfo(name, date_time or time.localtime()[:6])
+        if name.rsplit(".", 1)[-1].lower() in compressed_extensions:
+            info.compress_type = ZIP_STORED
+        else:
+            info.compress_type = ZIP_DEFLATED
+            # public since Python 3.13, private before
+            if hasattr(info, "compress_level"):
+                info.compress_level = self.compression_level
+            else:
+                info._compresslevel = self.compression_level
+        return info
+
+    def copies_raw(self, member_info):
+        """whether the compressed data of a member can be copied as it is"""
+        return (
+            self.raw_copy
+            and not member_info.flag_bits & 0x1
+            and member_info.compress_type in (ZIP_STORED, ZIP_DEFLATED)
+        )
+
+    @contextmanager
+    def open_page(self, name, member_info=None):
+        if member_info is not None and self.copies_raw(member_info):
+            page = write_raw_member(self.cbz, member_info, name)
+        else:
+            date_time = member_info.date_time if member_info is not None else None
+            page = self.cbz.open(self.zip_info(name, date_time), "w")
+        with page as dst:
+            yield dst
+        self.count_written()
+
+    def write_file(self, name, data):
+        self.cbz.writestr(
+            self.zip_info(name), data, compresslevel=self.compression_level
+        )
+        self.count_written()
+
+    def get_pages(self):
+        """the name and size in bytes of every page in the archive"""
+        return {
+            info.filename: info.file_size
+            for info in self.cbz.infolist()
+            if info.filename != "ComicInfo.xml"
+        }
+
+    def close(self):
+        if self.part_path is None:
+            self.cbz.close()
+            self.profile.counters["bytes_written"] += self.file.tell() - self.written
+            return
+        self.cbz.close()
+        self.profile.counters["bytes_written"] += (
+            os.path.getsize(self.part_path) - self.written
+        )
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        """closes an unfinished archive and removes its .part file"""
+        try:
+            self.cbz.close()
+        finally:
+            if self.part_path is not None and os.path.exists(self.part_path):
+                os.remove(self.part_path)
+
+
+class CbzUpdate(CbzOutput):
+    """
+    Replaces files of an existing .cbz archive, leaving its pages untouched.
+
+    The archive is opened for appending: a replaced entry is dropped from the
+    central directory and the new one is written after the last entry, or over
+    the old one when it is the last entry, which is where CbzOutput puts
+    ComicInfo.xml. Only that entry and the central directory are rewritten.
+    Without the zipfile internals this relies on, the whole archive is copied
+    instead.
+    """
+
+    def __init__(self, path, profile=None, options=default_options):
+        self.profile = profile or Profile()
+        self.compression_level = options.compression_level
+        self.path = path + ".cbz"
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"No converted book '{self.path}'")
+        self.cbz = ZipFile(self.path, "a", ZIP_DEFLATED)
+        self.raw_copy = has_zip_internals(self.cbz)
+        if self.raw_copy:
+            self.written = self.cbz.start_dir
+        else:
+            self.written = os.path.getsize(self.path)
+
+    def copy_without(self, name):
+        """copies the archive but its entry name and reopens the copy to append"""
+        self.cbz.close()
+        part_path = self.path + ".part"
+        with ZipFile(self.path) as source, ZipFile(part_path, "w") as target:
+            for info in source.infolist():
+                if info.filename != name:
+                    target.writestr(info, source.read(info))
+        os.replace(part_path, self.path)
+        self.cbz = ZipFile(self.path, "a", ZIP_DEFLATED)
+        self.written = 0
+
+    def write_file(self, name, data):
+        if not self.raw_copy:
+            if name in self.cbz.namelist():
+                self.copy_without(name)
+            super().write_file(name, data)
+            return
+        old = self.cbz.NameToInfo.pop(name, None)
+        if old is not None:
+            self.cbz.filelist.remove(old)
+            if all(
+                info.header_offset < old.header_offset for info in self.cbz.filelist
+            ):
+                self.cbz.start_dir = self.written = old.header_offset
+        super().write_file(name, data)
+
+    def close(self):
+        self.cbz.close()
+        self.profile.counters["bytes_written"] += (
+            os.path.getsize(self.path) - self.written
+        )
+
+    def abort(self):
+        """leaves the archive as it is, or with its new entry if that was written"""
+        self.cbz.close()
+
+
+def transcode_image(data, extension, transcode):
+    """
+    Re-encodes one page according to the transcode options.
+
+    Args:
+        data: The encoded image.
+        extension: The extension of the image, used when no format is set.
+        transcode: The Transcode options.
+
+    Returns:
+        A tuple of the encoded image without metadata and its extension.
+    """
+    extension = transcode.format or extension.lower()
+    image = Image.open(io.BytesIO(data))
+    if transcode.grayscale:
+        image = image.convert("L")
+    elif extension in ("jpg", "jpeg") and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if transcode.size:
+        image.thumbnail(transcode.size, Image.Resampling.LANCZOS)
+    image_file = io.BytesIO()
+    image.save(
+        image_file,
+        format=Image.registered_extensions()["." + extension],
+        quality=transcode.quality,
+    )
+    return image_file.getvalue(), extension
+
+
+def in_thread(items, depth=queue_depth):
+    """
+    Produces items on a thread of their own, ahead of the caller consuming them.
+
+    The items are handed over through a queue of at most depth items, so the
+    producer blocks instead of running arbitrarily far ahead. An exception
+    raised by the producer is raised again in the consumer, and a consumer
+    that stops early stops the producer too.
+    """
+    handoff = queue.Queue(depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                handoff.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = handoff.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def get_page_names(book_full, blank_extension):
+    """the file names of the pages of a book in the output, numbered in order"""
+    digits = len(str(len(book_full)))
+    return [
+        str(i).zfill(digits)
+        + "."
+        + (book["image"].rsplit(".")[1] if book["image"] else blank_extension)
+        for i, book in enumerate(book_full)
+    ]
+
+
+def read_page_chunks(ctx, book_full, output, blank_image, blank_extension, skip=()):
+    """
+    Reads the pages of a book in order, in chunks of at most ctx.chunk_size.
+
+    Members the output copies raw are read compressed, others decompressed,
+    blank pages are the blank image. Pages whose index is in skip are left out.
+
+    Yields:
+        (name, member_info, chunk) tuples, consecutive chunks of a page have
+        the same name. member_info is the ZipInfo of the page's member in the
+        epub, None for blank pages.
+    """
+    names = get_page_names(book_full, blank_extension)
+    for i, book in enumerate(book_full):
+        name = names[i]
+        if i in skip:
+            continue
+        if not book["image"]:
+            yield name, None, blank_image
+            continue
+        member_info = ctx.epub.getinfo(book["image"])
+        if output.copies_raw(member_info):
+            chunks = ctx.epub.read_raw(member_info, ctx.chunk_size)
+        else:
+            chunks = read_member_chunks(ctx.epub, member_info, ctx.chunk_size)
+        empty = True
+        for chunk in chunks:
+            empty = False
+            yield name, member_info, chunk
+        if empty:
+            yield name, member_info, b""
+
+
+def read_member_chunks(epub, member_info, chunk_size=chunk_size):
+    """reads the decompressed data of a member, at most chunk_size bytes at a time"""
+    with epub.open(member_info) as member:
+        yield from iter(partial(member.read, chunk_size), b"")
+
+
+def get_member_hash(epub, member_info, chunk_size=chunk_size):
+    """the sha256 of the decompressed data of a member"""
+    sha256 = hashlib.sha256()
+    for chunk in read_member_chunks(epub, member_info, chunk_size):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_fingerprint(sha256, size, crc):
+    """identifies an image by content, as listed in fingerprint files"""
+    return f"{sha256} {size} {crc:08x}"
+
+
+def load_fingerprints(path):
+    """
+    Reads a fingerprint file, one "sha256 size crc32" line per image as written
+    to the duplicates report. Empty lines and lines starting with # are ignored.
+
+    Returns:
+        A frozenset of the (crc, size, sha256) of the images.
+    """
+    fingerprints = set()
+    with open(path, encoding="utf-8") as fingerprint_file:
+        for line in fingerprint_file:
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            sha256, size, crc = line.split()[:3]
+            fingerprints.add((int(crc, 16), int(size), sha256))
+    return frozenset(fingerprints)
+
+
+def find_duplicate_pages(ctx, book_full):
+    """
+    Finds the pages showing the same image as an earlier page of the book.
+
+    Images are compared by the CRC and size in the central directory first,
+    only images sharing both with another one are read and hashed.
+
+    Returns:
+        A dict of the index of each duplicate page to the index of the first
+        page with the same image.
+    """
+    hashes = {}
+    first_pages = {}
+    duplicates = {}
+
+    def get_hash(member):
+        if member not in hashes:
+            hashes[member] = get_member_hash(
+                ctx.epub, ctx.epub.getinfo(member), ctx.chunk_size
             )
-    if btn_delete_temp:
-        for root, dirs, _ in os.walk(epub_filename):
-            for dir in dirs:
+        return hashes[member]
+
+    for i, book in enumerate(book_full):
+        if not book["image"]:
+            continue
+        member_info = ctx.epub.getinfo(book["image"])
+        candidates = first_pages.setdefault(
+            (member_info.CRC, member_info.file_size), []
+        )
+        for j in candidates:
+            if book_full[j]["image"] == book["image"] or get_hash(
+                book_full[j]["image"]
+            ) == get_hash(book["image"]):
+                duplicates[i] = j
+                break
+        else:
+            candidates.append(i)
+    return duplicates
+
+
+def drop_pages(ctx, book_full, fingerprints):
+    """
+    Removes the pages whose image is in a fingerprint list, recurring ads for
+    example. Only images matching the CRC and size of a fingerprint are hashed.
+    """
+    candidates = {(crc, size) for crc, size, _ in fingerprints}
+    kept = []
+    for book in book_full:
+        if book["image"]:
+            member_info = ctx.epub.getinfo(book["image"])
+            crc, size = member_info.CRC, member_info.file_size
+            if (crc, size) in candidates and (
+                crc,
+                size,
+                get_member_hash(ctx.epub, member_info, ctx.chunk_size),
+            ) in fingerprints:
+                rprint(f"[yellow]Info: Dropped fingerprinted page '{book['image']}'[/]")
+                continue
+        kept.append(book)
+    return kept
+
+
+def get_duplicate_images(books):
+    """
+    Finds the images found more than once in a batch of books.
+
+    Args:
+        books: The records of the converted books, see convert_book.
+
+    Returns:
+        A list of dicts with the "fingerprint", "size" and "pages" (dicts with
+        "book", "page" and "member") of each duplicate image, the images with
+        the most copies first.
+    """
+    candidates = {}
+    for book in books:
+        for page in book["pages"]:
+            if page["member"]:
+                candidates.setdefault((page["crc"], page["member_size"]), []).append(
+                    (book["epub_path"], page["name"], page["member"])
+                )
+    duplicates = {}
+    hashes = {}
+    for (crc, size), pages in candidates.items():
+        if len(pages) < 2:
+            continue
+        for epub_path, name, member in pages:
+            if (epub_path, member) not in hashes:
                 try:
-                    rmtree(os.path.join(root, dir))
-                    print(f"Info: Cleaned up temp folder '{os.path.join(root, dir)}'")
-                except Exception as e:
-                    rprint(f"Exception deleting: [red]{e}[/]")
+                    with ZipFile(epub_path) as epub:
+                        hashes[epub_path, member] = get_member_hash(
+                            epub, epub.getinfo(member)
+                        )
+                except (OSError, KeyError, BadZipFile):
+                    continue
+            fingerprint = get_fingerprint(hashes[epub_path, member], size, crc)
+            duplicates.setdefault(fingerprint, []).append(
+                {"book": epub_path, "page": name, "member": member}
+            )
+    return sorted(
+        (
+            {
+                "fingerprint": fingerprint,
+                "size": int(fingerprint.split()[1]),
+                "pages": pages,
+            }
+            for fingerprint, pages in duplicates.items()
+            if len(pages) > 1
+        ),
+        key=lambda image: (-len(image["pages"]), image["fingerprint"]),
+    )
+
+
+def read_pages(ctx, book_full, blank_image, blank_extension):
+    """
+    Reads the pages of a book in order, each as a whole.
+
+    Yields:
+        (name, data, extension) tuples, name being the page number.
+    """
+    digits = len(str(len(book_full)))
+    for i, book in enumerate(book_full):
+        if book["image"]:
+            data = ctx.epub.read(book["image"])
+            extension = book["image"].rsplit(".")[1]
+        else:
+            data = blank_image
+            extension = blank_extension
+        yield str(i).zfill(digits), data, extension
 
 
-def parse_reading_direction(epub_file, opf_path):
+def transcode_pages(pages, transcode, window=None):
+    """
+    Transcodes pages on a thread pool, PIL releases the GIL while decoding and
+    encoding.
+
+    At most two pages per thread, and no more than window, are held in memory,
+    and pages are yielded in order as they complete.
+
+    Args:
+        pages: (name, data, extension) tuples as yielded by read_pages.
+        transcode: The transcode options, see transcode_image.
+        window: Pages transcoded at once, two per thread if None.
+
+    Yields:
+        (name, None, data) tuples as yielded by read_page_chunks.
+    """
+    threads = transcode.threads or os.cpu_count() or 1
+    window = min(window or threads * 2, threads * 2)
+    pending = deque()
+
+    def oldest():
+        name, future = pending.popleft()
+        data, extension = future.result()
+        return name + "." + extension, None, data
+
+    with ThreadPoolExecutor(threads) as executor:
+        for name, data, extension in pages:
+            pending.append(
+                (name, executor.submit(transcode_image, data, extension, transcode))
+            )
+            if len(pending) >= window:
+                yield oldest()
+        while pending:
+            yield oldest()
+
+
+def write_pages(output, pages):
+    """writes (name, member_info, chunk) tuples as yielded by read_page_chunks"""
+    for name, chunks in groupby(pages, key=itemgetter(0)):
+        _, member_info, chunk = next(chunks)
+        with output.open_page(name, member_info) as page:
+            page.write(chunk)
+            for _, _, chunk in chunks:
+                page.write(chunk)
+
+
+def get_page_size(ctx, book_full):
+    """the (width, height) of the first image after the cover, (0, 0) if none"""
+    for i, book in enumerate(book_full):
+        if book["image"] and i > 0:
+            with ctx.epub.open(book["image"], "r") as zipimage:
+                image_size = get_image_size(zipimage)
+            if image_size is None:
+                with ctx.epub.open(book["image"], "r") as zipimage:
+                    image_size = Image.open(zipimage).size
+            return image_size
+    return 0, 0
+
+
+def extract_images(ctx, epub_filename, book_full, output=None, transcode=None):
+    extension = ""
+    if output is None:
+        output = FolderOutput(epub_filename)
+
+    # blank pages take the format of the first image
+    extension = next(
+        (book["image"].rsplit(".")[1] for book in book_full if book["image"]), "png"
+    )
+    # only books with a page without image need the blank page encoded
+    blank_image = b""
+    if not all(book["image"] for book in book_full):
+        dimension_x, dimension_y = get_page_size(ctx, book_full)
+        blank_image = get_blank_image(dimension_x, dimension_y, extension)
+    # reading the epub, transcoding and writing the output overlap, each runs
+    # on a thread of its own handing pages to the next through a bounded queue
+    depth = ctx.queue_depth
+    if transcode:
+        # whole pages wait before, in and after the pool, sized by the largest
+        page_size = max(
+            (
+                ctx.epub.getinfo(book["image"]).file_size
+                for book in book_full
+                if book["image"]
+            ),
+            default=len(blank_image),
+        )
+        depth = ctx.options.get_queue_depth(page_size, buffers=3)
+        window = depth if ctx.options.memory_limit else None
+        pages = transcode_pages(
+            in_thread(read_pages(ctx, book_full, blank_image, extension), depth),
+            transcode,
+            window,
+        )
+        duplicates = {}
+    else:
+        duplicates = (
+            find_duplicate_pages(ctx, book_full) if hasattr(output, "link_page") else {}
+        )
+        pages = read_page_chunks(
+            ctx, book_full, output, blank_image, extension, duplicates
+        )
+    write_pages(output, in_thread(pages, depth))
+    if duplicates:
+        names = get_page_names(book_full, extension)
+        for i, j in duplicates.items():
+            output.link_page(names[i], names[j])
+        rprint(
+            f"[yellow]Info: Stored {len(duplicates)} duplicate pages of "
+            f"'{os.path.basename(epub_filename)}' as links[/]"
+        )
+
+
+"""first bytes of the image formats a page can be in"""
+image_signatures = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a")
+"""media types of the images whose header is checked, svg and others are not"""
+raster_media_types = {"image/jpeg", "image/jpg", "image/png", "image/gif", "image/webp"}
+
+
+def is_image_header(header):
+    """whether the first 12 bytes of a file are those of a jpeg, png, gif or webp"""
+    return header.startswith(image_signatures) or (
+        header[:4] == b"RIFF" and header[8:12] == b"WEBP"
+    )
+
+
+def validate_epub(ctx):
+    """
+    Checks that a book can be converted, before anything is extracted.
+
+    Only the central directory and the .opf already read by the EpubContext
+    are looked at, plus META-INF/encryption.xml if there is one and the first
+    bytes of every jpeg, png, gif or webp image. Zip64 archives are fine, the
+    zip reader and the raw copy into .cbz archives both handle them.
+
+    Raises:
+        ValidationError: With one of these reasons:
+            encrypted: An entry is encrypted, or encryption.xml lists a page
+                or an image (DRM, unlike obfuscated fonts).
+            unsupported_compression: An entry uses a compression method the
+                zip reader doesn't support.
+            truncated: An entry extends past the end of the archive.
+            empty_spine: The .opf lists no pages.
+            missing_member: A page of the spine or an item of the manifest,
+                other than a remote resource, isn't in the archive.
+            no_images: The book has no images at all.
+            bad_image: An image declared as jpeg, png, gif or webp is none of
+                these.
+            Opening the EpubContext already raised not_a_zip, no_container
+            and missing_opf.
+    """
+    archive_size = ctx.file.seek(0, os.SEEK_END)
+    for info in ctx.epub.infolist():
+        if info.flag_bits & 0x1:
+            raise ValidationError("encrypted", f"'{info.filename}' is encrypted")
+        if info.compress_type not in (ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA):
+            raise ValidationError(
+                "unsupported_compression",
+                f"'{info.filename}' uses compression method {info.compress_type}",
+            )
+        if info.header_offset + info.compress_size > archive_size:
+            raise ValidationError(
+                "truncated", f"'{info.filename}' ends past the end of the archive"
+            )
+
+    if not ctx.opf.spine:
+        raise ValidationError("empty_spine", "the .opf lists no pages")
+    pages = []
+    for page_id in ctx.opf.spine:
+        item = ctx.opf.items.get(page_id)
+        page_file = ctx.resolve(item.get("href")) if item else None
+        if not page_file:
+            raise ValidationError(
+                "missing_member", f"page '{page_id}' of the spine is not in the archive"
+            )
+        pages.append(page_file)
+    images = []
+    rasters = []
+    for item in ctx.opf.manifest:
+        href = item.get("href", "")
+        if urlsplit(href).scheme:
+            continue
+        item_file = ctx.resolve(href)
+        if not item_file:
+            raise ValidationError(
+                "missing_member",
+                f"'{href or item.get('id')}' of the manifest is not in the archive",
+            )
+        media_type = item.get("media-type", "").lower()
+        if media_type.startswith("image/"):
+            images.append(item_file)
+        if media_type in raster_media_types:
+            rasters.append(item_file)
+    if not images:
+        images = rasters = [
+            name
+            for name in ctx.names
+            if name.rsplit(".", 1)[-1].lower() in ("jpg", "jpeg", "png")
+        ]
+        if not images:
+            raise ValidationError("no_images", "the book has no images")
+
+    encryption = "META-INF/encryption.xml"
+    if ctx.resolve(encryption, "") == encryption:
+        content = ctx.epub.read(encryption).decode("utf-8", errors="replace")
+        protected = set(pages) | set(images)
+        for uri in re.findall(r'URI="([^"]+)"', content):
+            if ctx.resolve(uri, "") in protected:
+                raise ValidationError("encrypted", f"'{uri}' is encrypted")
+
+    for image_file in rasters:
+        with ctx.epub.open(image_file) as image:
+            if not is_image_header(image.read(12)):
+                raise ValidationError(
+                    "bad_image", f"'{image_file}' is no jpeg, png, gif or webp"
+                )
+
+
+def parse_reading_direction(ctx):
     reading_direction = ""
 
-    with ZipFile(epub_file, "r") as epub:
-        opf_content = epub.read(opf_path).decode("utf-8")
-        pattern = r'page-progression-direction="(.+?)"'
-        match = re.findall(pattern, opf_content)
-        if match and match[0] == "rtl":
-            reading_direction = "YesAndRightToLeft"
-        else:
-            reading_direction = "No"
-        return reading_direction
+    if ctx.opf.page_progression_direction == "rtl":
+        reading_direction = "YesAndRightToLeft"
+    else:
+        reading_direction = "No"
+    return reading_direction
 
 
-def parse_opf_pages(epub_file, opf_path, page_ids):
+def parse_opf_pages(ctx, page_ids, resolve_images=True):
+    """
+    The pages of the spine with their image. Without resolve_images only the
+    first two pages are searched for theirs, enough to detect the cover and
+    the page size, the others get none.
+    """
     pages = []
     images = []
     book_full = []
     match_ids = []
-    cover_found = False
-    css_path = get_css_file(epub_file, opf_path)
-
-    with ZipFile(epub_file, "r") as epub:
-        print(page_ids)
-        with epub.open(opf_path) as opf_content:
-            soup = BeautifulSoup(opf_content, features="xml")
-            items = soup.find("manifest").find_all("item")
-            for page_id in page_ids:
-                for item in items:
-                    match_id = item.attrs["id"]
-                    print("matchid", item)
-                    if match_id and match_id == page_id:
-                        print("MATCH")
-                        match_ids.append(match_id)
-                        match_href = item.attrs["href"]
-                        if match_href:
-                            pages.append(match_href)
-                            break
-            print(pages)
-            for i, page in enumerate(pages):
-                image_path = find_image_path_in_file(epub, page)
-                if image_path:
-                    image_path = [
-                        path
-                        for path in epub.namelist()
-                        if remove_starting_dots(image_path) in path
-                    ]
-                    images.append(image_path[0])
-                    book = {"page": page, "number": i, "image": image_path[0]}
-                    cover_found = True
-                elif match_ids[i] and not cover_found:
-                    css_image = find_image_path_in_css(epub, css_path, match_ids[i][0])
-                    css_image = [
-                        path
-                        for path in epub.namelist()
-                        if remove_starting_dots(css_image) in path
-                    ]
-                    book = {"page": page, "number": i, "image": css_image[0]}
-                else:
-                    book = {"page": page, "number": i, "image": ""}
-                book_full.append(book)
+
+    for page_id in page_ids:
+        item = ctx.opf.items.get(page_id)
+        if item and item.get("href"):
+            match_ids.append(page_id)
+            pages.append(item["href"])
+    for i, page in enumerate(pages):
+        if not resolve_images and i > 1:
+            book_full.append({"page": page, "number": i, "image": ""})
+            continue
+        image_path = find_image_path_in_file(ctx, page)
+        if image_path:
+            images.append(image_path)
+            book = {"page": page, "number": i, "image": image_path}
+        else:
+            css_image = find_image_path_in_css(ctx, match_ids[i])
+            book = {"page": page, "number": i, "image": css_image or ""}
+        book_full.append(book)
     return book_full
 
 
-def parse_epub_opf(epub_file, opf_path):
-    pages = []
-    with ZipFile(epub_file, "r") as epub:
-        with epub.open(opf_path) as opf_content:
-            soup = BeautifulSoup(opf_content, features="xml")
-            itemrefs = soup.find("spine").find_all("itemref")
+def get_trailing_number(href):
+    """the last number in the file name of an href, None if it has none"""
+    match = re.search(r"(\d+)[^/\d]*$", href)
+    return int(match.group(1)) if match else None
+
+
+def map_fixed_layout_pages(ctx):
+    """
+    Finds the image of every page of a fixed-layout image book from the .opf.
 
-            for itemref in itemrefs:
-                pages.append(itemref.attrs["idref"])
+    Pre-paginated books usually list one image per spine page, in spine order.
+    Then the i-th spine page shows the i-th image of the manifest, which is
+    trusted if their file names carry the same number (p-001.xhtml and
+    i-001.jpg) or the same name (cover.xhtml and cover.jpg). Only pages for
+    which neither holds are read to check their image. The images found are
+    remembered by the EpubContext, so parsing the spine and the table of
+    contents doesn't read the pages again.
 
-    book_full = parse_opf_pages(epub_file, opf_path, pages)
+    Returns:
+        True if every page was mapped, False if the book doesn't qualify or
+        its manifest doesn't match its pages and it must be parsed page by
+        page.
+    """
+    if ctx.opf.properties.get("rendition:layout") != "pre-paginated":
+        return False
+    pages = [ctx.opf.items.get(page_id, {}).get("href") for page_id in ctx.opf.spine]
+    images = [
+        item
+        for item in ctx.opf.items_by_media_type_prefix("image/")
+        if item.get("href")
+    ]
+    if len(images) == len(pages) + 1:
+        # a cover image only named by <meta name="cover"> has no page
+        images = [
+            item
+            for item in images
+            if item.get("id") != ctx.opf.cover
+            and "cover-image" not in item.get("properties", "").split()
+        ] or images
+    if not pages or len(images) != len(pages) or not all(pages):
+        return False
+
+    page_images = {}
+    for page, item in zip(pages, images):
+        page_file = ctx.resolve(page)
+        image_file = ctx.resolve(item["href"])
+        if not page_file or not image_file:
+            return False
+        page_name = posixpath.splitext(posixpath.basename(page_file))[0]
+        image_name = posixpath.splitext(posixpath.basename(image_file))[0]
+        page_number = get_trailing_number(page_name)
+        if page_number is None:
+            matches = page_name == image_name
+        else:
+            matches = page_number == get_trailing_number(image_name)
+        if not matches and find_image_path_in_file(ctx, page_file, "") != image_file:
+            return False
+        page_images[page_file] = image_file
+    ctx.page_images.update(page_images)
+    return True
+
+
+def parse_epub_opf(ctx, resolve_images=True):
+    book_full = parse_opf_pages(ctx, ctx.opf.spine, resolve_images)
     return book_full
 
 
-def parse_epub_toc(epub_file, opf_path):
+def parse_epub_toc(ctx, resolve_images=True):
     chapters = []
 
-    with ZipFile(epub_file, "r") as epub:
-        ncx_path = get_ncx_file(epub_file, opf_path)
-
-        if ncx_path.endswith(".ncx"):
-            toc_content = epub.read(ncx_path).decode("utf-8")
-            soup = BeautifulSoup(toc_content, features="xml")
-            nav_points = soup.find_all("navPoint")
-            for nav_point in nav_points:
-                title = nav_point.navLabel.text.strip()
-                page = nav_point.content.attrs["src"].rsplit("#", 1)[0].strip()
-                chapter = {"title": title, "page": page}
-                image_path = find_image_path_in_file(epub, page)
+    ncx_path = get_ncx_file(ctx)
+    if not ncx_path:
+        # a book without a table of contents is converted without chapters
+        return chapters
+    toc_dir = posixpath.dirname(ncx_path)
+
+    if ncx_path.endswith(".ncx"):
+        toc_content = ctx.epub.read(ncx_path).decode("utf-8")
+        soup = BeautifulSoup(toc_content, features="xml")
+        nav_points = soup.find_all("navPoint")
+        for nav_point in nav_points:
+            title = nav_point.navLabel.text.strip()
+            page = nav_point.content.attrs["src"].rsplit("#", 1)[0].strip()
+            chapter = {"title": title, "page": page}
+            if resolve_images:
+                image_path = find_image_path_in_file(ctx, page, toc_dir)
                 if image_path:
-                    image_path = [
-                        path
-                        for path in epub.namelist()
-                        if remove_starting_dots(image_path) in path
-                    ]
-                    chapter["image"] = image_path[0]
-                chapters.append(chapter)
-        elif ncx_path.endswith(".xhtml"):
-            nav = []
-            is_between_tags = False
-            pattern = r'<a href="(.*?)">(.*?)</a>'
-            with epub.open(ncx_path) as toc_content:
-                for line in toc_content:
-                    line = line.decode("utf-8").strip()
-                    if 'epub:type="toc"' in line:
-                        is_between_tags = True
-                    elif "</nav" in line:
-                        if is_between_tags:
-                            nav.append(line)
-                            break
-                        is_between_tags = False
+                    chapter["image"] = image_path
+            chapters.append(chapter)
+    elif ncx_path.endswith(".xhtml"):
+        nav = []
+        is_between_tags = False
+        pattern = r'<a href="(.*?)">(.*?)</a>'
+        with ctx.epub.open(ncx_path) as toc_content:
+            for line in toc_content:
+                line = line.decode("utf-8").strip()
+                if 'epub:type="toc"' in line:
+                    is_between_tags = True
+                elif "</nav" in line:
                     if is_between_tags:
                         nav.append(line)
-                for line in nav:
-                    matches = re.findall(pattern, line)
-                    for match in matches:
-                        chapter = {
-                            "title": match[1].strip(),
-                            "page": match[0].rsplit("#", 1)[0].strip(),
-                        }
+                        break
+                    is_between_tags = False
+                if is_between_tags:
+                    nav.append(line)
+            for line in nav:
+                matches = re.findall(pattern, line)
+                for match in matches:
+                    chapter = {
+                        "title": match[1].strip(),
+                        "page": match[0].rsplit("#", 1)[0].strip(),
+                    }
+                    if resolve_images:
                         image_path = find_image_path_in_file(
-                            epub, match[0].rsplit("#", 1)[0]
+                            ctx, match[0].rsplit("#", 1)[0], toc_dir
                         )
                         if image_path:
-                            image_path = [
-                                path
-                                for path in epub.namelist()
-                                if remove_starting_dots(image_path) in path
-                            ]
-                            chapter["image"] = image_path[0]
-                        chapters.append(chapter)
-    for i, chapter in enumerate(chapters):
-        if i < (len(chapters) - 1) and chapter["page"] == chapters[i + 1]["page"]:
-            chapter["title"] = chapter["title"] + " - " + chapters[i + 1]["title"]
-            del chapters[i + 1]
-    return chapters
+                            chapter["image"] = image_path
+                    chapters.append(chapter)
+    merged_chapters = []
+    for chapter in chapters:
+        if merged_chapters and merged_chapters[-1]["page"] == chapter["page"]:
+            merged_chapters[-1]["title"] += " - " + chapter["title"]
+        else:
+            merged_chapters.append(chapter)
+    return merged_chapters
 
 
 def remove_starting_dots(path):
@@ -391,61 +1633,105 @@ def remove_starting_dots(path):
         return path
 
 
-def find_image_path_in_css(epub, filename, page_id):
-    image_path = None
-    filename = remove_starting_dots(filename)
-    filename = [path for path in epub.namelist() if filename in path]
-
-    if filename and filename[0] in epub.namelist():
-        file_content = epub.read(filename[0]).decode("utf-8")
-        image_path_patterns_css = [
-            rf"#{page_id}(.*?)background-image:(.*?)url\(\"(.*?\.jpg|.*?\.jpeg|.*?\.png)\"\)"
-        ]
-        pattern_inner = r"url\(\"(.*?\.jpg|.*?\.jpeg|.*?\.png)\"\)"
-        for pattern in image_path_patterns_css:
-            image_match = re.search(pattern, file_content)
-            if image_match and 'url("' in image_match[0]:
-                match = re.search(pattern_inner, image_match[0])
-                if match:
-                    image_path = match.group(1)
-                    break
-    else:
-        rprint(f"[blue]file not found {filename}[/]")
-    return image_path
+"""the rules of a stylesheet, comments removed, nested @media rules included"""
+pattern_css_rule = re.compile(r"([^{}]+)\{([^{}]*)\}")
+pattern_css_comment = re.compile(r"/\*.*?\*/", re.DOTALL)
+"""the image of a background or background-image declaration"""
+pattern_css_background = re.compile(
+    r"background(?:-image)?\s*:[^;]*?url\(\s*['\"]?([^'\")]+?)['\"]?\s*\)"
+)
+pattern_css_id = re.compile(r"#([\w-]+)")
 
 
-def find_image_path_in_file(epub, filename):
-    image_path = None
-    filename = remove_starting_dots(filename)
-    filename = [path for path in epub.namelist() if filename in path]
+def get_stylesheet_index(ctx):
+    """
+    Maps the selectors of every stylesheet of a book to their background image.
 
-    if (
-        filename
-        and filename[0] in epub.namelist()
-        and (filename[0].endswith(".xhtml") or filename[0].endswith(".html"))
-    ):
-        file_content = epub.read(filename[0]).decode("utf-8")
-        image_path_patterns = [
-            r'src="(.*?\.jpg|.*?\.jpeg|.*?\.png)"',
-            r'xlink:href="(.*?\.jpg|.*?\.jpeg|.*?\.png)"',
-        ]
-        for pattern in image_path_patterns:
-            image_match = re.search(pattern, file_content)
-            if image_match:
-                image_path = image_match.group(1)
-                break
-    elif (
-        filename
-        and filename[0] in epub.namelist()
-        and (
-            filename[0].endswith(".jpg")
-            or filename[0].endswith(".jpeg")
-            or filename[0].endswith(".png")
+    Every stylesheet in the manifest is read and parsed once per book, the
+    index is kept by the EpubContext. Each selector of a rule with a background
+    image is a key, and so is every #id it contains, so "body#p1, #p2" makes
+    "#p1" and "#p2" resolve to the image. Earlier rules win over later ones.
+    """
+    if ctx.css_images is not None:
+        return ctx.css_images
+    ctx.css_images = {}
+    for css_file in get_css_files(ctx):
+        content = pattern_css_comment.sub(
+            "", ctx.epub.read(css_file).decode("utf-8", errors="replace")
         )
+        for selectors, declarations in pattern_css_rule.findall(content):
+            background = pattern_css_background.search(declarations)
+            if not background:
+                continue
+            image_path = ctx.resolve(background.group(1), posixpath.dirname(css_file))
+            if not image_path:
+                continue
+            for selector in selectors.split(","):
+                selector = selector.strip()
+                ctx.css_images.setdefault(selector, image_path)
+                for css_id in pattern_css_id.findall(selector):
+                    ctx.css_images.setdefault("#" + css_id, image_path)
+    return ctx.css_images
+
+
+def find_image_path_in_css(ctx, page_id):
+    """the background image the stylesheets give the element with id page_id"""
+    if not page_id:
+        return None
+    return get_stylesheet_index(ctx).get("#" + page_id)
+
+
+"""first image referenced by a page, an <img src> or an svg <image xlink:href>"""
+pattern_page_image = re.compile(r'(?:src|xlink:href)="([^"]*?\.(?:jpg|jpeg|png))"')
+
+
+def search_member(epub, member, pattern, chunk_size=16 * 1024, overlap=1024):
+    """
+    Searches an archive member for a pattern, reading it only up to the match.
+
+    Args:
+        epub: The ZipFile containing the member.
+        member: Name of the member to search.
+        pattern: Compiled regex, matches are expected to be shorter than overlap.
+        chunk_size: Number of bytes read at a time.
+        overlap: Number of already searched characters kept and searched again
+            with the next chunk, so matches spanning two chunks are found. At
+            most chunk_size bytes and overlap characters are held in memory.
+
+    Returns:
+        The first match or None.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    content = ""
+    with epub.open(member) as member_file:
+        while chunk := member_file.read(chunk_size):
+            content = content[-overlap:] + decoder.decode(chunk)
+            match = pattern.search(content)
+            if match:
+                return match
+    return None
+
+
+def find_image_path_in_file(ctx, filename, base_dir=None):
+    image_path = None
+    page_file = ctx.resolve(filename, base_dir)
+    if page_file in ctx.page_images:
+        return ctx.page_images[page_file]
+
+    if page_file and (page_file.endswith(".xhtml") or page_file.endswith(".html")):
+        image_match = search_member(ctx.epub, page_file, pattern_page_image)
+        if image_match:
+            image_path = ctx.resolve(image_match.group(1), posixpath.dirname(page_file))
+    elif page_file and (
+        page_file.endswith(".jpg")
+        or page_file.endswith(".jpeg")
+        or page_file.endswith(".png")
     ):
-        image_path = filename[0]
+        image_path = page_file
     else:
         rprint(f"[blue]file not found {filename}[/]")
+    if page_file:
+        ctx.page_images[page_file] = image_path
     return image_path
 
 
@@ -473,217 +1759,1423 @@ def convert_to_date(date_str):
     try:
         if len(date_str) == 4 and date_str.isdigit():
             return datetime.strptime(date_str, "%Y")
+        elif len(date_str) == 7:
+            return datetime.strptime(date_str, "%Y-%m")
         else:
             return datetime.strptime(date_str, "%Y-%m-%d")
     except ValueError:
         return None
 
 
+def get_bookmarks(chapters, book_full):
+    """the chapter title starting on each page, "" for other pages"""
+    bookmarks = {}
+    for chapter in chapters:
+        bookmarks[get_page_key(chapter["page"])] = chapter["title"]
+    return [
+        "Cover" if i == 0 else bookmarks.get(get_page_key(book["page"]), "")
+        for i, book in enumerate(book_full)
+    ]
+
+
+def get_book_record(
+    ctx, epub_filename, chapters, book_full, metadata, direction, written
+):
+    """
+    Everything known about a converted book, as exported to the catalog.
+
+    Args:
+        written: The name and size of every page in the output, as returned
+            by the get_pages of the output.
+
+    Returns:
+        A dict with the series, volume, title, author, publisher, language,
+        date (YYYY-MM-DD), description and reading direction, the page count,
+        the width and height of the pages, the bytes of all pages, the
+        chapters (dicts with the "page" number and "title") and the pages in
+        the output (dicts with the page "name" and "size" in bytes in the
+        output, the image "member" in the epub, "" for blank pages, and its
+        "crc" and "member_size").
+    """
+    series, volume = extract_version(os.path.basename(epub_filename))
+    author, title, language, publisher, date, description = metadata[0]
+    date_full = convert_to_date(date) if date else None
+    width, height = get_page_size(ctx, book_full)
+    # transcoding may have changed the extension the page was written with
+    names = {name.rsplit(".", 1)[0]: name for name in written}
+    pages = []
+    for name, book in zip(get_page_names(book_full, ""), book_full):
+        name = names.get(name.rsplit(".", 1)[0], "")
+        if not name:
+            continue
+        member_info = ctx.epub.getinfo(book["image"]) if book["image"] else None
+        pages.append(
+            {
+                "name": name,
+                "size": written[name],
+                "member": book["image"],
+                "crc": member_info.CRC if member_info else 0,
+                "member_size": member_info.file_size if member_info else 0,
+            }
+        )
+    return {
+        "series": series.replace("_", ":"),
+        "volume": volume,
+        "title": title.strip(),
+        "author": author.strip(),
+        "publisher": publisher.strip(),
+        "language": language.strip(),
+        "date": date_full.strftime("%Y-%m-%d") if date_full else "",
+        "description": description.strip(),
+        "reading_direction": direction,
+        "page_count": len(book_full),
+        "width": width,
+        "height": height,
+        "image_bytes": sum(page["size"] for page in pages),
+        "chapters": [
+            {"page": i, "title": bookmark.strip()}
+            for i, bookmark in enumerate(get_bookmarks(chapters, book_full))
+            if bookmark
+        ],
+        "pages": pages,
+    }
+
+
 def write_chapters_to_txt(
-    chapters, epub_filename, root_dir, reading_direction, book_full, metadata
+    chapters,
+    epub_filename,
+    root_dir,
+    reading_direction,
+    book_full,
+    metadata,
+    output=None,
+    options=default_options,
 ):
     folder_name, volume_number = extract_version(os.path.basename(epub_filename))
-    text_path = os.path.join(root_dir, os.path.basename(epub_filename), "ComicInfo.xml")
-    os.makedirs(epub_filename, exist_ok=True)
-    bookmark = ""
+    if output is None:
+        output = FolderOutput(
+            os.path.join(root_dir, os.path.basename(epub_filename)), options=options
+        )
     author, title, language, publisher, date, description = metadata[0]
 
-    with open(text_path, "w", encoding="utf-8") as text_file:
+    with io.StringIO() as text_file:
         text_file.write("<?xml version='1.0' encoding='utf-8'?>\n")
         text_file.write(
             '<ComicInfo xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">\n'
         )
-        if btn_series:
+        if options.series:
             text_file.write(
-                "  <Series>" + folder_name.replace("_", ":") + "</Series>\n"
+                "  <Series>" + escape(folder_name.replace("_", ":")) + "</Series>\n"
             )
-        if title and btn_title:
-            text_file.write("  <Title>" + title.strip() + "</Title>\n")
-        if volume_number and btn_volume_no:
+        if title and options.title:
+            text_file.write("  <Title>" + escape(title.strip()) + "</Title>\n")
+        if volume_number and options.volume_no:
             text_file.write("  <Volume>" + str(volume_number) + "</Volume>\n")
-        if publisher and btn_publisher:
-            text_file.write("  <Publisher>" + publisher.strip() + "</Publisher>\n")
-        if language and btn_language:
-            text_file.write("  <LanguageISO>" + language.strip() + "</LanguageISO>\n")
-        if author and btn_author:
-            text_file.write("  <Writer>" + author.strip() + "</Writer>\n")
+        if publisher and options.publisher:
+            text_file.write(
+                "  <Publisher>" + escape(publisher.strip()) + "</Publisher>\n"
+            )
+        if language and options.language:
+            text_file.write(
+                "  <LanguageISO>" + escape(language.strip()) + "</LanguageISO>\n"
+            )
+        if author and options.author:
+            text_file.write("  <Writer>" + escape(author.strip()) + "</Writer>\n")
 
         text_file.write("  <Pages>\n")
 
-        for i, book in enumerate(book_full):
+        for i, bookmark in enumerate(get_bookmarks(chapters, book_full)):
             text_file.write("    <Page ")
-            if i == 0:
-                bookmark = "Cover"
-            else:
-                bookmark = ""
-                for chapter in chapters:
-                    if os.path.basename(
-                        chapter["page"].rsplit("#", 1)[0]
-                    ) == os.path.basename(book["page"]):
-                        bookmark = chapter["title"]
-
-            if bookmark and btn_chapters:
-                text_file.write(f'Bookmark="{bookmark.strip()}" ')
+            if bookmark and options.chapters:
+                text_file.write(f"Bookmark={quoteattr(bookmark.strip())} ")
             text_file.write(f'Image="{i}" />\n')
 
         text_file.write("  </Pages>\n")
-        if date and btn_date:
-            date_full = convert_to_date(date)
+        date_full = convert_to_date(date) if date and options.date else None
+        if date_full:
             text_file.write("  <Day>" + str(date_full.day) + "</Day>\n")
             text_file.write("  <Month>" + str(date_full.month) + "</Month>\n")
             text_file.write("  <Year>" + str(date_full.year) + "</Year>\n")
-        if btn_reading_dir:
+        if options.reading_dir:
             text_file.write(f"  <Manga>{reading_direction}</Manga>\n")
-        if description and btn_description:
-            text_file.write(f"  <Summary>{description.strip()}</Summary>\n")
+        if description and options.description:
+            text_file.write(f"  <Summary>{escape(description.strip())}</Summary>\n")
         text_file.write("</ComicInfo>")
+        output.write_file("ComicInfo.xml", text_file.getvalue().encode("utf-8"))
 
 
-def get_opf_file(epub_file):
+def get_opf_file(epub):
     container = "META-INF/container.xml"
-    with ZipFile(epub_file, "r") as epub:
-        container_content = epub.read(container).decode("utf-8")
-        pattern = r'<rootfile full-path="(.+?)"'
-        match = re.findall(pattern, container_content)
-        return match[0]
-
-
-def get_css_file(epub_file, opf_path):
-    with ZipFile(epub_file, "r") as epub:
-        opf_content = epub.read(opf_path).decode("utf-8")
-        if "/" in opf_path:
-            opf_path = opf_path.rsplit("/", 1)[0] + "/"
-        else:
-            opf_path = ""
+    try:
+        container_content = epub.read(container).decode("utf-8", errors="replace")
+    except KeyError as e:
+        raise ValidationError("no_container", f"no {container}") from e
+    pattern = r'<rootfile full-path="(.+?)"'
+    match = re.findall(pattern, container_content)
+    if not match:
+        raise ValidationError("no_container", f"no <rootfile> in {container}")
+    return match[0]
+
+
+def get_css_files(ctx):
+    """the archive entries of the stylesheets listed in the manifest"""
+    css_files = []
+    for item in ctx.opf.items_by_media_type("text/css"):
+        css_file = ctx.resolve(item.get("href"))
+        if css_file and css_file not in css_files:
+            css_files.append(css_file)
+    return css_files
+
+
+def get_ncx_file(ctx):
+    items = ctx.opf.items_by_media_type(
+        "application/x-dtbncx+xml"
+    ) or ctx.opf.items_by_property("nav")
+
+    for item in items:
+        if item.get("href"):
+            ncx_file = ctx.resolve(item["href"])
+            if ncx_file:
+                return ncx_file
+    rprint(f"[red]couldnt find .ncx file in .opf of {ctx.epub_file}[/]")
+    return
+
+
+def get_epub_filename(epub_file):
+    return epub_file.split(os.path.sep)[-1].rsplit(".")[0]
+
+
+def get_output_path(epub_file, root_dir, cbz=False):
+    output_path = os.path.join(root_dir, get_epub_filename(epub_file))
+    return output_path + ".cbz" if cbz else output_path
+
+
+def get_options(options=default_options):
+    """the options a book is converted with, a changed option reconverts it"""
+    # the switches keep the names of the btn_* globals they used to be, so
+    # books cached before stay current
+    cached = {
+        "btn_" + option.name: int(getattr(options, option.name))
+        for option in fields(options)
+        if option.type is bool
+    }
+    if options.compression_level is not None:
+        cached["compression_level"] = options.compression_level
+    if options.transcode:
+        cached["transcode"] = {
+            "size": list(options.transcode.size) if options.transcode.size else None,
+            "format": options.transcode.format,
+            "quality": options.transcode.quality,
+            "grayscale": options.transcode.grayscale,
+        }
+    if options.fingerprints:
+        cached["fingerprints"] = hashlib.sha256(
+            json.dumps(
+                sorted(
+                    get_fingerprint(sha256, size, crc)
+                    for crc, size, sha256 in options.fingerprints
+                )
+            ).encode()
+        ).hexdigest()
+    return cached
+
+
+def get_file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(partial(file.read, 1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_cache_entry(epub_file, options=default_options):
+    stat = os.stat(epub_file)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": get_file_hash(epub_file),
+        "version": __version__,
+        "options": get_options(options),
+    }
+
+
+class ConversionCache:
+    """
+    Persistent record of the books converted by previous runs.
 
-        pattern = r'<item (.*?)media-type="text/css"(.*?)/>'
+    Books are keyed by their absolute path and remembered with their size,
+    modification time and sha256, the converter version and the options they
+    were converted with. A book is only converted again if one of those changed
+    or its output is gone. The cache is saved regularly during a run, so an
+    interrupted batch resumes where it stopped.
+    """
+
+    save_interval = 10
 
+    def __init__(self, path):
+        self.path = path
+        self.books = {}
+        self.last_save = time.monotonic()
         try:
-            matches = re.findall(pattern, opf_content)
-            pattern_inner = r'href="(.*?)"'
-            for item in matches:
-                if 'href="' in item[0]:
-                    match = re.search(pattern_inner, item[0])
-                    if match:
-                        link = match.group(1)
-                        opf_path = opf_path + link
-                elif 'href="' in item[1]:
-                    match = re.search(pattern_inner, item[1])
-                    if match:
-                        link = match.group(1)
-                        opf_path = opf_path + link
-            return opf_path
-        except IndexError:
-            rprint(f"[red]couldnt find .css file in .opf of {epub_file}[/]")
-            return
-        rprint(f"[red]returned outside of try with {matches}[/]")
-        return
+            with open(path, encoding="utf-8") as cache_file:
+                self.books = json.load(cache_file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            rprint(f"[yellow]Warning: Ignoring unreadable cache '{path}': {e}[/]")
+
+    def is_current(self, epub_file, root_dir, options=default_options):
+        entry = self.books.get(os.path.abspath(epub_file))
+        if (
+            not entry
+            or entry["version"] != __version__
+            or entry["options"] != get_options(options)
+            or not os.path.exists(get_output_path(epub_file, root_dir, options.cbz))
+        ):
+            return False
+        stat = os.stat(epub_file)
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns != entry["mtime"]:
+            if get_file_hash(epub_file) != entry["sha256"]:
+                return False
+            entry["mtime"] = stat.st_mtime_ns
+        return True
+
+    def update_options(self, epub_file, options=default_options):
+        """records the current options of a book whose ComicInfo.xml was rewritten"""
+        entry = self.books.get(os.path.abspath(epub_file))
+        if entry:
+            entry["options"].update(
+                (name, value)
+                for name, value in get_options(options).items()
+                if name.startswith("btn_")
+            )
+
+    def add(self, epub_file, entry):
+        self.books[os.path.abspath(epub_file)] = entry
+        if time.monotonic() - self.last_save > self.save_interval:
+            self.save()
+
+    def save(self):
+        part_path = self.path + ".part"
+        with open(part_path, "w", encoding="utf-8") as cache_file:
+            json.dump(self.books, cache_file)
+        os.replace(part_path, self.path)
+        self.last_save = time.monotonic()
 
 
-def get_ncx_file(epub_file, opf_path):
-    with ZipFile(epub_file, "r") as epub:
-        opf_content = epub.read(opf_path).decode("utf-8")
-        if "/" in opf_path:
-            opf_path = opf_path.rsplit("/", 1)[0] + "/"
+class JobQueue:
+    """
+    Books found by the watch mode, waiting to be converted, kept in SQLite.
+
+    A book is queued again when its size or modification time changes. A
+    failed conversion is retried up to retries times, waiting retry_delay
+    seconds before the first retry and twice as long before each next one.
+    Jobs still running when the watcher stopped are queued again when it
+    starts.
+    """
+
+    retry_delay = 30
+
+    def __init__(self, path, retries=3):
+        self.retries = retries
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, size INTEGER, "
+            "mtime INTEGER, status TEXT, attempts INTEGER, error TEXT, "
+            "not_before REAL, updated REAL)"
+        )
+        self.db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        self.db.commit()
+
+    def add(self, epub_file, size, mtime):
+        """queues a book unless this version of it is known, returns whether it was"""
+        row = self.db.execute(
+            "SELECT size, mtime FROM jobs WHERE path = ?", (epub_file,)
+        ).fetchone()
+        if row == (size, mtime):
+            return False
+        self.db.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, 'queued', 0, '', 0, ?)",
+            (epub_file, size, mtime, time.time()),
+        )
+        self.db.commit()
+        return True
+
+    def take(self, limit):
+        """marks up to limit queued books as running, oldest first, and returns them"""
+        now = time.time()
+        rows = self.db.execute(
+            "SELECT path FROM jobs WHERE status = 'queued' AND not_before <= ? "
+            "ORDER BY updated LIMIT ?",
+            (now, max(limit, 0)),
+        ).fetchall()
+        self.db.executemany(
+            "UPDATE jobs SET status = 'running', updated = ? WHERE path = ?",
+            [(now, epub_file) for (epub_file,) in rows],
+        )
+        self.db.commit()
+        return [epub_file for (epub_file,) in rows]
+
+    def finish(self, epub_file, error="", retry=True):
+        """records the outcome of a conversion, queuing a retry if it failed"""
+        now = time.time()
+        if not error:
+            self.db.execute(
+                "UPDATE jobs SET status = 'done', error = '', updated = ? "
+                "WHERE path = ?",
+                (now, epub_file),
+            )
         else:
-            opf_path = ""
+            (attempts,) = self.db.execute(
+                "SELECT attempts + 1 FROM jobs WHERE path = ?", (epub_file,)
+            ).fetchone()
+            status = "queued" if retry and attempts <= self.retries else "failed"
+            self.db.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, error = ?, "
+                "not_before = ?, updated = ? WHERE path = ?",
+                (
+                    status,
+                    attempts,
+                    error,
+                    now + self.retry_delay * 2 ** (attempts - 1),
+                    now,
+                    epub_file,
+                ),
+            )
+        self.db.commit()
 
-        pattern = r'<item (.*?)media-type="application/x-dtbncx\+xml"(.*?)/>'
-        pattern_nav = r'<item (.*?)?properties="nav"(.*?)?/>'
+    def status(self):
+        """the number of books by status and the failed books with their errors"""
+        counts = dict(
+            self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        )
+        failed = self.db.execute(
+            "SELECT path, error FROM jobs WHERE status = 'failed' ORDER BY path"
+        ).fetchall()
+        return counts, failed
 
-        try:
-            matches = re.findall(pattern, opf_content)
-            matches_nav = re.findall(pattern_nav, opf_content)
-            pattern_inner = r'href="(.*?)"'
-
-            if matches:
-                for item in matches:
-                    if 'href="' in item[0]:
-                        match = re.search(pattern_inner, item[0])
-                        if match:
-                            link = match.group(1)
-                            opf_path = opf_path + link
-                            break
-                    elif 'href="' in item[1]:
-                        match = re.search(pattern_inner, item[1])
-                        if match:
-                            link = match.group(1)
-                            opf_path = opf_path + link
-                            break
-                return opf_path
-            elif matches_nav:
-                for item in matches_nav:
-                    if 'href="' in item[0]:
-                        match = re.search(pattern_inner, item[0])
-                        if match:
-                            link = match.group(1)
-                            opf_path = opf_path + link
-                            break
-                    elif 'href="' in item[1]:
-                        match = re.search(pattern_inner, item[1])
-                        if match:
-                            link = match.group(1)
-                            opf_path = opf_path + link
-                            break
-                return opf_path
-        except IndexError:
-            rprint(f"[red]couldnt find .ncx file in .opf of {epub_file}[/]")
+    def close(self):
+        self.db.close()
+
+
+class Catalog:
+    """
+    Exports the records of converted books to one file a library server can
+    import in bulk, see get_book_record.
+
+    A path ending in .jsonl gets one json line per book converted by the run.
+    Any other path is a SQLite database with a books, a chapters and a pages
+    table, where books converted again replace their earlier rows, so it grows
+    into an index of the whole library.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.file = None
+        if path.endswith(".jsonl"):
+            self.file = open(path, "w", encoding="utf-8")
             return
-        rprint(f"[red]returned outside of try with {matches}[/]")
-        return
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS books (epub_path TEXT PRIMARY KEY, "
+            "output TEXT, series TEXT, volume INTEGER, title TEXT, author TEXT, "
+            "publisher TEXT, language TEXT, date TEXT, description TEXT, "
+            "reading_direction TEXT, page_count INTEGER, width INTEGER, "
+            "height INTEGER, image_bytes INTEGER, converted REAL);"
+            "CREATE TABLE IF NOT EXISTS chapters (epub_path TEXT, page INTEGER, "
+            "title TEXT);"
+            "CREATE TABLE IF NOT EXISTS pages (epub_path TEXT, name TEXT, "
+            "size INTEGER, member TEXT, crc INTEGER, member_size INTEGER);"
+            "CREATE INDEX IF NOT EXISTS chapters_book ON chapters (epub_path);"
+            "CREATE INDEX IF NOT EXISTS pages_book ON pages (epub_path);"
+        )
 
+    def add(self, book):
+        if self.file:
+            self.file.write(json.dumps(book) + "\n")
+            return
+        epub_path = book["epub_path"]
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO books VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    epub_path,
+                    book["output"],
+                    book["series"],
+                    book["volume"],
+                    book["title"],
+                    book["author"],
+                    book["publisher"],
+                    book["language"],
+                    book["date"],
+                    book["description"],
+                    book["reading_direction"],
+                    book["page_count"],
+                    book["width"],
+                    book["height"],
+                    book["image_bytes"],
+                    time.time(),
+                ),
+            )
+            self.db.execute("DELETE FROM chapters WHERE epub_path = ?", (epub_path,))
+            self.db.executemany(
+                "INSERT INTO chapters VALUES (?, ?, ?)",
+                [
+                    (epub_path, chapter["page"], chapter["title"])
+                    for chapter in book["chapters"]
+                ],
+            )
+            self.db.execute("DELETE FROM pages WHERE epub_path = ?", (epub_path,))
+            self.db.executemany(
+                "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        epub_path,
+                        page["name"],
+                        page["size"],
+                        page["member"],
+                        page["crc"],
+                        page["member_size"],
+                    )
+                    for page in book["pages"]
+                ],
+            )
 
-def process_epub(epub_file, root_dir, opf_path):
-    chapters = parse_epub_toc(epub_file, opf_path)
-    epub_filename = epub_file.split(os.path.sep)[-1].rsplit(".")[0]
-    book_full = parse_epub_opf(epub_file, opf_path)
-    #
-    metadata = [parse_metadata(epub_file, opf_path)]
-    #
-    book_full = parse_alternative_cover(epub_file, opf_path, book_full)
-    #
-    chapters = parse_alternative_toc(epub_file, opf_path, chapters, book_full)
+    def close(self):
+        if self.file:
+            self.file.close()
+        else:
+            self.db.close()
+
+
+def process_epub(
+    epub_file,
+    root_dir,
+    opf_path,
+    options=default_options,
+    metadata_only=False,
+):
+    """
+    converts one epub, returns the profile report of the conversion and the
+    record of the book, see get_book_record, with its epub and output paths
+
+    with metadata_only, only the ComicInfo.xml of the already converted book
+    is written again, its pages are neither validated nor extracted
+    """
+    profile = Profile()
+    epub_filename = get_epub_filename(epub_file)
+    output_path = os.path.join(root_dir, epub_filename)
+    with profile.stage("open_epub"):
+        ctx = EpubContext(epub_file, opf_path, profile, options)
+    with ctx:
+        if metadata_only:
+            if options.cbz:
+                output = CbzUpdate(output_path, profile, options)
+            elif os.path.isdir(output_path):
+                output = FolderOutput(output_path, profile, options)
+            else:
+                raise FileNotFoundError(f"No converted book '{output_path}'")
+        else:
+            with profile.stage("validate_epub"):
+                validate_epub(ctx)
+            if options.cbz:
+                output = CbzOutput(output_path, profile, options)
+            else:
+                output = FolderOutput(output_path, profile, options)
+        book = convert_book(
+            ctx, epub_filename, root_dir, output, options, metadata_only
+        )
+    book["epub_path"] = epub_file
+    book["output"] = output.path
     #
-    if (
-        os.path.basename(chapters[0]["page"].rsplit("#", 1)[0])
-        == os.path.basename(book_full[1]["page"])
-        and chapters[0]["title"] == "Cover"
+    if metadata_only:
+        rprint(f"[green]Updated metadata of '{os.path.basename(epub_filename)}'[/]")
+    else:
+        rprint(f"[green]Processed '{os.path.basename(epub_filename)}'[/]")
+    return profile.report(), book
+
+
+def convert_book(
+    ctx,
+    epub_filename,
+    root_dir,
+    output,
+    options=default_options,
+    metadata_only=False,
+):
+    """
+    Converts an open epub into an output, closing the output when it is done
+    and aborting it when the conversion fails.
+
+    Args:
+        ctx: The EpubContext of the book.
+        epub_filename: The file name of the epub without its extension, series
+            and volume are taken from it.
+        root_dir: Directory a folder output is written to.
+        output: The FolderOutput or CbzOutput the book is written to.
+        options: The Options of the conversion.
+        metadata_only: Only write ComicInfo.xml, the pages are not extracted
+            and, without fingerprints, only the first two are searched for
+            their image, so the record of the book has no member for others.
+
+    Returns:
+        The record of the book, see get_book_record.
+    """
+    profile = ctx.profile
+    # ComicInfo.xml only needs the pages of the spine, unless pages are dropped
+    # by their image
+    resolve_images = not metadata_only or bool(options.fingerprints)
+    try:
+        if resolve_images:
+            with profile.stage("map_fixed_layout_pages"):
+                map_fixed_layout_pages(ctx)
+        with profile.stage("parse_epub_toc"):
+            chapters = parse_epub_toc(ctx, resolve_images)
+        with profile.stage("parse_epub_opf"):
+            book_full = parse_epub_opf(ctx, resolve_images)
+        #
+        with profile.stage("parse_metadata"):
+            metadata = [parse_metadata(ctx)]
+        #
+        with profile.stage("parse_alternative_cover"):
+            book_full = parse_alternative_cover(ctx, book_full)
+        #
+        with profile.stage("parse_alternative_toc"):
+            chapters = parse_alternative_toc(ctx, chapters, book_full)
+        #
+        if (
+            chapters
+            and len(book_full) > 1
+            and get_page_key(chapters[0]["page"]) == get_page_key(book_full[1]["page"])
+            and chapters[0]["title"] == "Cover"
+        ):
+            del book_full[1]
+            rprint(
+                f"[yellow]Info: Removed duplicate cover for '{os.path.basename(epub_filename)}'[/]"
+            )
+        #
+        if options.fingerprints:
+            with profile.stage("drop_pages"):
+                book_full = drop_pages(ctx, book_full, options.fingerprints)
+        #
+        if options.extract_images and not metadata_only:
+            with profile.stage("extract_images"):
+                extract_images(ctx, epub_filename, book_full, output, options.transcode)
+        #
+        with profile.stage("parse_reading_direction"):
+            reading_direction = parse_reading_direction(ctx)
+        #
+        if options.comicinfo:
+            with profile.stage("write_chapters_to_txt"):
+                write_chapters_to_txt(
+                    chapters,
+                    epub_filename,
+                    root_dir,
+                    reading_direction,
+                    book_full,
+                    metadata,
+                    output,
+                    options,
+                )
+        with profile.stage("close_output"):
+            output.close()
+    except BaseException:
+        output.abort()
+        raise
+    return get_book_record(
+        ctx,
+        epub_filename,
+        chapters,
+        book_full,
+        metadata,
+        reading_direction,
+        output.get_pages(),
+    )
+
+
+def convert(
+    source,
+    target=None,
+    name=None,
+    opf_path=None,
+    options=default_options,
+):
+    """
+    Converts one epub to a cbz archive in memory, without touching the disk.
+
+    Nothing is read from or written to the current directory and no state is
+    kept between calls, so several books can be converted concurrently on
+    threads of one process.
+
+    Args:
+        source: Path of the epub, its content as bytes or a seekable binary
+            file object opened for reading.
+        target: Seekable binary file object the cbz is written to, None to
+            return the cbz as bytes.
+        name: File name of the epub, series and volume are taken from it.
+            Defaults to the name of the source path or file object.
+        opf_path: Path of the .opf inside the epub, found in its
+            META-INF/container.xml if None.
+        options: The Options of the conversion, its output mode is ignored.
+
+    Returns:
+        The cbz as bytes, or target if one was given.
+    """
+    if name is None:
+        path = source if isinstance(source, (str, os.PathLike)) else None
+        path = path or getattr(source, "name", None)
+        name = get_epub_filename(os.fspath(path)) if path else ""
+    cbz_file = io.BytesIO() if target is None else target
+    with EpubContext(source, opf_path, options=options) as ctx:
+        validate_epub(ctx)
+        output = CbzOutput(cbz_file, ctx.profile, options)
+        convert_book(ctx, name, "", output, options)
+    return cbz_file.getvalue() if target is None else target
+
+
+"""what a watch mode worker is doing, see init_worker and stop_worker"""
+worker_state = {"converting": False, "stopped": None}
+
+
+def stop_worker(signum, frame):
+    """
+    Stops a watch mode worker on SIGINT or SIGTERM without breaking the pool.
+
+    Ctrl+C and service managers signal the workers along with the main process.
+    Only a book being converted is interrupted, which removes its unfinished
+    output. Anywhere else the worker may hold a lock of the pool's task queue
+    that the pool can't get back, so it carries on and skips the books it is
+    handed once the main process sets the stopped event.
+    """
+    if worker_state["converting"]:
+        raise KeyboardInterrupt
+
+
+def block_stop_signals(block):
+    """blocks or unblocks SIGINT and SIGTERM, where the platform can"""
+    if hasattr(signal, "pthread_sigmask"):
+        how = signal.SIG_BLOCK if block else signal.SIG_UNBLOCK
+        signal.pthread_sigmask(how, {signal.SIGINT, signal.SIGTERM})
+
+
+def init_worker(force_terminal, stopped=None):
+    """
+    Keeps rich colors in worker output that is buffered before printing. Given
+    the stopped event of the watch mode, signals stop the worker as stop_worker
+    does.
+    """
+    if stopped is not None:
+        worker_state["stopped"] = stopped
+        signal.signal(signal.SIGINT, stop_worker)
+        signal.signal(signal.SIGTERM, stop_worker)
+        block_stop_signals(False)
+    if force_terminal:
+        reconfigure(force_terminal=True)
+
+
+def convert_epub(
+    epub_path,
+    root_dir,
+    opf_path,
+    options=default_options,
+    metadata_only=False,
+    capture=False,
+):
+    """
+    Converts one epub, isolating its errors from the rest of the batch.
+
+    Args:
+        epub_path: Path of the epub to convert.
+        root_dir: Directory the output folder is written to.
+        opf_path: Path of the .opf inside the epub.
+        options: The Options of the conversion.
+        metadata_only: Only write ComicInfo.xml again, see process_epub.
+        capture: Buffer everything printed during the conversion so that
+            parallel workers don't interleave their output.
+
+    Returns:
+        A dict with the epub path, an error message and its reason code (see
+        validate_epub, conversion_error for other errors, both empty on
+        success), the captured output, the cache entry (None with
+        metadata_only), the profile report and the record of the converted
+        book (all None on failure).
+    """
+    output = io.StringIO()
+    error = ""
+    reason = ""
+    cache_entry = None
+    profile = None
+    book = None
+    with redirect_stdout(output) if capture else nullcontext():
+        try:
+            profile, book = process_epub(
+                epub_path, root_dir, opf_path, options, metadata_only
+            )
+            if not metadata_only:
+                cache_entry = get_cache_entry(epub_path, options)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            reason = getattr(e, "reason", "conversion_error")
+            rprint(
+                f"[red]Error: Failed to convert '{os.path.basename(epub_path)}': {error}[/]"
+            )
+    return {
+        "epub_path": epub_path,
+        "error": error,
+        "reason": reason,
+        "output": output.getvalue(),
+        "cache_entry": cache_entry,
+        "profile": profile,
+        "book": book,
+    }
+
+
+def star_convert_epub(args, capture=False):
+    stopped = worker_state["stopped"]
+    if stopped is None:
+        return convert_epub(*args, capture=capture)
+    # a stopped book is reported as failed, the worker itself keeps running
+    # until the pool is closed, see stop_worker
+    result = {
+        "epub_path": args[0],
+        "error": "Stopped",
+        "reason": "conversion_error",
+        "output": "",
+        "cache_entry": None,
+        "profile": None,
+        "book": None,
+    }
+    if stopped.is_set():
+        return result
+    try:
+        worker_state["converting"] = True
+        result = convert_epub(*args, capture=capture)
+        worker_state["converting"] = False
+    except KeyboardInterrupt:
+        worker_state["converting"] = False
+    return result
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Convert .epub manga and comics in the current folder to cbz-ready folders."
+    )
+    parser.add_argument(
+        "folder",
+        nargs="?",
+        default=os.getcwd(),
+        help="folder searched for .epub files and written to (default: current)",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="only convert .epub files matching this glob, can be repeated; "
+        "globs with a / match the path below the folder, others the file name",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="skip files and folders matching this glob, can be repeated",
+    )
+    parser.add_argument(
+        "--config",
+        metavar="PATH",
+        help="read the options from a json file, keyed by the names of the "
+        "fields of epub2cbz.Options and drop_pages, the options given on the "
+        "command line take precedence",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of books converted in parallel, 0 uses all cores (default: 1)",
+    )
+    parser.add_argument(
+        "--cbz",
+        action=argparse.BooleanOptionalAction,
+        help="write .cbz archives directly instead of cbz-ready folders",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        choices=range(10),
+        metavar="0-9",
+        help="deflate level of the compressed entries of .cbz archives "
+        "(default: zlib's)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        metavar="KB",
+        help="KB of image data read and written at a time, bounds the memory each "
+        f"book needs (default: {chunk_size // 1024})",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=int,
+        metavar="MB",
+        help="MB of encoded image data each book holds between reading and "
+        "writing, shortens the queues when chunks or transcoded pages are large "
+        "(default: no limit)",
+    )
+    transcode = parser.add_argument_group(
+        "image transcoding",
+        "re-encode the pages, dropping their metadata, when any of these is given",
+    )
+    transcode.add_argument(
+        "--resize",
+        metavar="WIDTHxHEIGHT",
+        help="scale pages down to fit the resolution of the reading device",
+    )
+    transcode.add_argument(
+        "--image-format",
+        choices=["jpg", "png", "webp"],
+        help="convert pages to this format",
+    )
+    transcode.add_argument(
+        "--quality",
+        type=int,
+        help="jpg and webp quality of re-encoded pages (default: 85)",
+    )
+    transcode.add_argument(
+        "--grayscale", action="store_true", help="convert pages to grayscale"
+    )
+    transcode.add_argument(
+        "--strip-metadata",
+        action="store_true",
+        help="re-encode pages only to drop their metadata",
+    )
+    transcode.add_argument(
+        "--transcode-threads",
+        type=int,
+        metavar="N",
+        help="threads re-encoding the pages of a book, 0 shares the cores "
+        "between the jobs (default: 0)",
+    )
+    parser.add_argument(
+        "--drop-pages",
+        metavar="FINGERPRINTS",
+        help="leave out pages whose image is listed in this file, one "
+        "'sha256 size crc32' fingerprint per line as in the --duplicates report",
+    )
+    parser.add_argument(
+        "--catalog",
+        metavar="PATH",
+        help="export the metadata, chapters, pages and output path of the "
+        "converted books to a .jsonl file or, for any other name, a SQLite "
+        "database updated by every run",
+    )
+    parser.add_argument(
+        "--duplicates",
+        metavar="REPORT",
+        help="write the images found more than once in the batch to a .jsonl file",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only validate the books and print why invalid ones can't be converted",
+    )
+    parser.add_argument(
+        "--metadata-only",
+        action="store_true",
+        help="only write ComicInfo.xml again into books already converted, "
+        "leaving their pages untouched",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="convert all books, even those unchanged since the last run",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help=f"don't read or write the {cache_filename} file of converted books",
+    )
+    watch = parser.add_argument_group(
+        "watch mode",
+        f"keep running and convert books as they arrive, queued in {jobs_filename}",
+    )
+    watch.add_argument(
+        "--watch",
+        action="store_true",
+        help="watch the folder for new or changed .epub files until interrupted",
+    )
+    watch.add_argument(
+        "--poll",
+        type=float,
+        default=2.0,
+        metavar="SECONDS",
+        help="seconds between looks at the watched folder (default: 2)",
+    )
+    watch.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="times a failed book is converted again (default: 3)",
+    )
+    watch.add_argument(
+        "--status",
+        action="store_true",
+        help="print the queued, running, done and failed books and exit",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="REPORT",
+        help="write the time and i/o of each stage of each book to a .jsonl file",
+    )
+    args = parser.parse_args(args)
+    if args.resize and not re.fullmatch(r"\d+x\d+", args.resize):
+        parser.error("--resize expects WIDTHxHEIGHT, for example 1072x1448")
+    return args
+
+
+def get_transcode(args, config=None, jobs=1):
+    """
+    the transcode options given on the command line over those of the config
+    file, None if neither asks for transcoding
+    """
+    if config is None and not (
+        args.resize or args.image_format or args.grayscale or args.strip_metadata
     ):
-        del book_full[1]
-        rprint(
-            f"[yellow]Info: Removed duplicate cover for '{os.path.basename(epub_filename)}'[/]"
+        return None
+    transcode = Transcode(**(config or {}))
+    return replace(
+        transcode,
+        size=tuple(int(size) for size in args.resize.split("x"))
+        if args.resize
+        else transcode.size,
+        format=args.image_format or transcode.format,
+        quality=args.quality if args.quality is not None else transcode.quality,
+        grayscale=args.grayscale or transcode.grayscale,
+        threads=args.transcode_threads
+        or transcode.threads
+        or max(1, (os.cpu_count() or 1) // jobs),
+    )
+
+
+def load_config(path):
+    """
+    Reads the options of a json config file.
+
+    Keys are the names of the fields of Options, transcode being an object
+    keyed by those of Transcode, except that the fingerprints are given as the
+    path of a file to load_fingerprints under drop_pages.
+
+    Raises:
+        ValueError: If the file has keys that are not options.
+    """
+    with open(path, encoding="utf-8") as config_file:
+        config = json.load(config_file)
+    names = {option.name for option in fields(Options)} - {"fingerprints"}
+    unknown = set(config) - names - {"drop_pages"}
+    if unknown:
+        raise ValueError(f"Unknown options in '{path}': {', '.join(sorted(unknown))}")
+    unknown = set(config.get("transcode") or {}) - {
+        option.name for option in fields(Transcode)
+    }
+    if unknown:
+        raise ValueError(
+            f"Unknown transcode options in '{path}': {', '.join(sorted(unknown))}"
         )
-    #
-    if btn_extract_images:
-        extract_images(epub_file, epub_filename, book_full)
-    #
-    reading_direction = parse_reading_direction(epub_file, opf_path)
-    #
-    if btn_comicinfo:
-        write_chapters_to_txt(
-            chapters, epub_filename, root_dir, reading_direction, book_full, metadata
+    if config.get("drop_pages"):
+        config["fingerprints"] = load_fingerprints(config["drop_pages"])
+    config.pop("drop_pages", None)
+    return config
+
+
+def load_options(args):
+    """the Options of a run, those of the --config file overridden by the command line"""
+    config = load_config(args.config) if args.config else {}
+    for name in ("cbz", "jobs", "compression_level"):
+        if getattr(args, name) is not None:
+            config[name] = getattr(args, name)
+    if args.chunk_size is not None:
+        config["chunk_size"] = args.chunk_size * 1024
+    if args.memory_limit is not None:
+        config["memory_limit"] = args.memory_limit * 1024 * 1024
+    if args.drop_pages:
+        config["fingerprints"] = load_fingerprints(args.drop_pages)
+    if config.get("jobs", 1) <= 0:
+        config["jobs"] = os.cpu_count() or 1
+    config["transcode"] = get_transcode(
+        args, config.get("transcode"), config.get("jobs", 1)
+    )
+    return Options(**config)
+
+
+def matches_globs(relative_path, patterns):
+    """
+    Whether a path relative to the converted folder, with / separators,
+    matches one of the glob patterns. Patterns without a / match file names.
+    """
+    name = relative_path.rsplit("/", 1)[-1]
+    return any(
+        fnmatch(relative_path if "/" in pattern else name, pattern)
+        for pattern in patterns
+    )
+
+
+def is_wanted(path, root_dir, include=(), exclude=()):
+    """whether a file or folder below root_dir passes the include and exclude globs"""
+    relative_path = os.path.relpath(path, root_dir).replace(os.sep, "/")
+    if exclude and matches_globs(relative_path, exclude):
+        return False
+    return not include or matches_globs(relative_path, include)
+
+
+def scan_epubs(root_dir, include=(), exclude=()):
+    """
+    Yields the paths of the .epub files below root_dir as they are found.
+
+    Folders are listed one at a time with os.scandir, the files of a folder
+    before its subfolders, both in name order. Folders matching an exclude
+    glob aren't entered at all.
+    """
+    folders = [root_dir]
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as scan:
+                entries = sorted(scan, key=lambda entry: entry.name)
+        except OSError as e:
+            rprint(f"[yellow]Warning: Skipping unreadable folder '{folder}': {e}[/]")
+            continue
+        subfolders = []
+        for entry in entries:
+            if entry.is_dir():
+                if is_wanted(entry.path, root_dir, (), exclude):
+                    subfolders.append(entry.path)
+            elif entry.name.endswith(".epub") and is_wanted(
+                entry.path, root_dir, include, exclude
+            ):
+                yield entry.path
+        folders.extend(reversed(subfolders))
+
+
+def list_epubs(root_dir, listings, include=(), exclude=()):
+    """
+    Lists the .epub files below root_dir with their os.stat_result.
+
+    listings remembers the epubs and subfolders of every folder along with the
+    folder's modification time, only folders changed since the last call are
+    listed again. Files and folders are filtered like scan_epubs does.
+    """
+    folders = [root_dir]
+    while folders:
+        folder = folders.pop()
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            listing = listings.get(folder)
+            if listing is None or listing[0] != mtime:
+                epubs, subfolders = [], []
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            if is_wanted(entry.path, root_dir, (), exclude):
+                                subfolders.append(entry.path)
+                        elif entry.name.endswith(".epub") and is_wanted(
+                            entry.path, root_dir, include, exclude
+                        ):
+                            epubs.append(entry.path)
+                listing = listings[folder] = (mtime, epubs, subfolders)
+        except OSError:
+            listings.pop(folder, None)
+            continue
+        folders.extend(listing[2])
+        for epub_path in listing[1]:
+            try:
+                yield epub_path, os.stat(epub_path)
+            except OSError:
+                pass
+
+
+def stop_watching(signum, frame):
+    """lets a service manager stop the watch mode like Ctrl+C does"""
+    raise KeyboardInterrupt
+
+
+def watch(args, root_dir, options=default_options):
+    """
+    Converts the books arriving in root_dir on a pool of workers started once,
+    until interrupted.
+
+    A book is queued once its size and modification time stayed the same for
+    one poll, so books still being copied are left alone. Up to two books per
+    worker are handed to the pool at a time.
+    """
+    cache = ConversionCache(os.path.join(root_dir, cache_filename))
+    job_queue = JobQueue(os.path.join(root_dir, jobs_filename), args.retries)
+    catalog = Catalog(args.catalog) if args.catalog else None
+    jobs = options.jobs
+    listings = {}
+    polled = {}
+    queued = {}
+    running = {}
+    rprint(f"[bold]Watching '{root_dir}' with {jobs} job(s), press Ctrl+C to stop[/]")
+    stopped = Event()
+    signal.signal(signal.SIGTERM, stop_watching)
+    # a KeyboardInterrupt raised in the fork handlers of Pool() is lost, so the
+    # workers are started with the signals blocked until they handle them
+    block_stop_signals(True)
+    pool = Pool(jobs, initializer=init_worker, initargs=(sys.stdout.isatty(), stopped))
+    try:
+        block_stop_signals(False)
+        while True:
+            found = {}
+            for epub_path, stat in list_epubs(
+                root_dir, listings, args.include, args.exclude
+            ):
+                found[epub_path] = version = (stat.st_size, stat.st_mtime_ns)
+                if polled.get(epub_path) != version:
+                    continue
+                if queued.get(epub_path) == version:
+                    continue
+                queued[epub_path] = version
+                if job_queue.add(epub_path, *version) and (
+                    args.cache
+                    and not args.force
+                    and cache.is_current(epub_path, root_dir, options)
+                ):
+                    job_queue.finish(epub_path)
+            polled = found
+
+            for epub_path in job_queue.take(jobs * 2 - len(running)):
+                running[epub_path] = pool.apply_async(
+                    star_convert_epub,
+                    ((epub_path, root_dir, None, options),),
+                    {"capture": True},
+                )
+            for epub_path, pending in list(running.items()):
+                if not pending.ready():
+                    continue
+                del running[epub_path]
+                result = pending.get()
+                sys.stdout.write(result["output"])
+                sys.stdout.flush()
+                if args.cache and result["cache_entry"]:
+                    cache.add(epub_path, result["cache_entry"])
+                if catalog and result["book"]:
+                    catalog.add(result["book"])
+                # an invalid book fails the same way every time
+                job_queue.finish(
+                    epub_path,
+                    result["error"],
+                    result["reason"] == "conversion_error",
+                )
+            time.sleep(min(args.poll, 0.2) if running else args.poll)
+    except KeyboardInterrupt:
+        rprint("[bold]Stopped watching, unfinished books are converted next time[/]")
+    finally:
+        if args.cache:
+            cache.save()
+        if catalog:
+            catalog.close()
+        job_queue.close()
+        # closing rather than terminating the pool, a worker killed while it
+        # holds a lock of the task queue would leave terminate() waiting forever
+        stopped.set()
+        pool.close()
+        pool.join()
+    return 0
+
+
+def print_status(root_dir):
+    """prints the books of the watch mode's queue by status"""
+    if not os.path.exists(os.path.join(root_dir, jobs_filename)):
+        rprint(f"No books queued in '{root_dir}', start one with --watch")
+        return 0
+    job_queue = JobQueue(os.path.join(root_dir, jobs_filename))
+    counts, failed = job_queue.status()
+    job_queue.close()
+    rprint(
+        ", ".join(
+            f"{counts.get(status, 0)} {status}"
+            for status in ("queued", "running", "done", "failed")
         )
-    #
-    rprint(f"[green]Processed '{os.path.basename(epub_filename)}'[/]")
+    )
+    for epub_path, error in failed:
+        rprint(f"[red]  failed: '{os.path.basename(epub_path)}': {error}[/]")
+    return 0
+
+
+def check_books(root_dir, include=(), exclude=()):
+    """
+    Validates the books below root_dir without converting them, prints the
+    reason code of every invalid one and returns 1 if there are any.
+    """
+    start = time.perf_counter()
+    reasons = {}
+    checked = 0
+    for epub_path in scan_epubs(root_dir, include, exclude):
+        checked += 1
+        try:
+            with EpubContext(epub_path) as ctx:
+                validate_epub(ctx)
+        except Exception as e:
+            reason = getattr(e, "reason", "conversion_error")
+            reasons[reason] = reasons.get(reason, 0) + 1
+            message = str(e) if isinstance(e, ValidationError) else f"{reason}: {e}"
+            rprint(f"[red]'{os.path.relpath(epub_path, root_dir)}': {message}[/]")
+    invalid = sum(reasons.values())
+    rprint(
+        f"[bold]Checked {checked} books in {time.perf_counter() - start:.1f}s, "
+        f"{invalid} invalid[/]"
+    )
+    for reason, count in sorted(reasons.items()):
+        rprint(f"  {reason}: {count}")
+    return 1 if invalid else 0
 
 
 def main():
-    root_dir = os.getcwd()
-    epub_paths = []
+    args = parse_args()
+    try:
+        options = load_options(args)
+    except (OSError, ValueError) as e:
+        rprint(f"[red]Error: {e}[/]")
+        return 2
+    root_dir = os.path.abspath(args.folder)
+    if args.status:
+        return print_status(root_dir)
+    if args.check:
+        return check_books(root_dir, args.include, args.exclude)
+    if args.watch:
+        return watch(args, root_dir, options)
+    failed = []
+    skipped = 0
+    start = time.perf_counter()
+    cache = ConversionCache(os.path.join(root_dir, cache_filename))
+
+    def find_books():
+        # runs while books are converted, so the first ones start right away
+        nonlocal skipped
+        for epub_path in scan_epubs(root_dir, args.include, args.exclude):
+            if (
+                args.cache
+                and not args.force
+                and not args.metadata_only
+                and cache.is_current(epub_path, root_dir, options)
+            ):
+                skipped += 1
+                continue
+            yield epub_path, root_dir, None, options, args.metadata_only
+
+    jobs = options.jobs
+    results = []
+    report = open(args.profile, "w", encoding="utf-8") if args.profile else None
+    catalog = Catalog(args.catalog) if args.catalog else None
+
+    def add_result(result):
+        results.append(result)
+        if args.cache and result["cache_entry"]:
+            cache.add(result["epub_path"], result["cache_entry"])
+        elif args.cache and args.metadata_only and not result["error"]:
+            cache.update_options(result["epub_path"], options)
+        if catalog and result["book"]:
+            catalog.add(result["book"])
+        if report:
+            report.write(
+                json.dumps(
+                    {
+                        "book": result["epub_path"],
+                        "error": result["error"],
+                        "reason": result["reason"],
+                        **(result["profile"] or {}),
+                    }
+                )
+                + "\n"
+            )
 
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in filenames:
-            if filename.endswith(".epub"):
-                epub_path = os.path.join(dirpath, filename)
-                opf_path = get_opf_file(epub_path)
-                epub_paths.append((epub_path, root_dir, opf_path))
+    def print_result(result):
+        sys.stdout.write(result["output"])
+        sys.stdout.flush()
+        add_result(result)
 
-    # with Pool() as pool:
-    # pool.starmap(process_epub, epub_paths)
-    for pathi in epub_paths:
-        print(pathi)
-        process_epub(pathi[0], pathi[1], pathi[2])
+    try:
+        if jobs == 1:
+            for pathi in find_books():
+                add_result(convert_epub(*pathi))
+        else:
+            # books are handed to the pool as they are found, at most two per
+            # worker ahead of the oldest one, whose output is printed first
+            with Pool(
+                jobs, initializer=init_worker, initargs=(sys.stdout.isatty(),)
+            ) as pool:
+                pending = deque()
+                for book in find_books():
+                    pending.append(
+                        pool.apply_async(star_convert_epub, (book,), {"capture": True})
+                    )
+                    if len(pending) >= jobs * 2:
+                        print_result(pending.popleft().get())
+                while pending:
+                    print_result(pending.popleft().get())
+    finally:
+        if args.cache:
+            cache.save()
+        if catalog:
+            catalog.close()
+
+    failed.extend(
+        (result["epub_path"], result["error"]) for result in results if result["error"]
+    )
+    converted = len(results) - len([result for result in results if result["error"]])
+    elapsed = time.perf_counter() - start
+    if report:
+        stages = {}
+        for result in results:
+            for name, stage in (result["profile"] or {}).get("stages", {}).items():
+                total = stages.setdefault(name, dict.fromkeys(stage, 0))
+                for key, value in stage.items():
+                    total[key] += value
+        report.write(
+            json.dumps(
+                {
+                    "batch": {
+                        "seconds": elapsed,
+                        "jobs": jobs,
+                        "converted": converted,
+                        "failed": len(failed),
+                        "skipped": skipped,
+                        "stages": stages,
+                    }
+                }
+            )
+            + "\n"
+        )
+        report.close()
+        rprint(f"Profile written to '{args.profile}'")
+    if args.duplicates:
+        duplicates = get_duplicate_images(
+            [result["book"] for result in results if result["book"]]
+        )
+        with open(args.duplicates, "w", encoding="utf-8") as duplicates_file:
+            for image in duplicates:
+                duplicates_file.write(json.dumps(image) + "\n")
+        rprint(
+            f"{len(duplicates)} duplicate images written to '{args.duplicates}', "
+            f"{sum(image['size'] * (len(image['pages']) - 1) for image in duplicates)}"
+            " bytes stored more than once"
+        )
+    rprint(
+        f"[bold]{'Updated' if args.metadata_only else 'Converted'} {converted} of "
+        f"{converted + len(failed)} books "
+        f"in {elapsed:.1f}s using {jobs} job(s)[/]"
+    )
+    if skipped:
+        rprint(f"[bold]Skipped {skipped} books unchanged since the last run[/]")
+    for epub_path, error in failed:
+        rprint(f"[red]  failed: '{os.path.basename(epub_path)}': {error}[/]")
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())